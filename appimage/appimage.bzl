@@ -2,6 +2,7 @@
 
 load("@rules_appimage//appimage/private:mkapprun.bzl", "make_apprun")
 load("@rules_appimage//appimage/private:runfiles.bzl", "collect_runfiles_info")
+load("@rules_cc//cc:find_cc_toolchain.bzl", "find_cc_toolchain", "use_cc_toolchain")
 
 MKSQUASHFS_ARGS = [
     "-exit-on-error",
@@ -16,48 +17,233 @@ MKSQUASHFS_ARGS = [
     "-all-time",
     "0",
 ]
-MKSQUASHFS_NUM_PROCS = 4
-MKSQUASHFS_MEM_MB = 1024
 
-def _resources(*_args, **_kwargs):
+# SquashFS uses one compressor for the whole image, so this selects the codec for everything that is compressed.
+# Blocks that don't get smaller are always stored uncompressed by mksquashfs.
+COMPRESSION_ARGS = {
+    "": [],
+    "fast": ["-comp", "lz4"],
+    "none": ["-noI", "-noId", "-noD", "-noF", "-noX"],
+    "small": ["-comp", "xz"],
+}
+
+# Number of processors and amount of memory (in MB) that mksquashfs may use, and that are reserved for the AppImage
+# action. The resource_set callbacks must be top-level functions, so there is one per resource class.
+MKSQUASHFS_RESOURCES = {
+    "large": struct(cpu = 8, memory_mb = 2048),
+    "medium": struct(cpu = 4, memory_mb = 1024),
+    "small": struct(cpu = 1, memory_mb = 256),
+    "xlarge": struct(cpu = 16, memory_mb = 4096),
+}
+
+# Upper bounds (exclusive) of the number of packaged files for each resource class when it is chosen automatically.
+_AUTO_RESOURCES_MAX_FILES = [
+    ("small", 1000),
+    ("medium", 10000),
+    ("large", 100000),
+]
+
+def _resource_set(resources):
+    return {"cpu": resources.cpu, "memory": resources.memory_mb}
+
+def _resources_small(*_args, **_kwargs):
     """See https://bazel.build/rules/lib/builtins/actions#run.resource_set."""
-    return {"cpu": MKSQUASHFS_NUM_PROCS, "memory": MKSQUASHFS_MEM_MB}
+    return _resource_set(MKSQUASHFS_RESOURCES["small"])
+
+def _resources_medium(*_args, **_kwargs):
+    """See https://bazel.build/rules/lib/builtins/actions#run.resource_set."""
+    return _resource_set(MKSQUASHFS_RESOURCES["medium"])
+
+def _resources_large(*_args, **_kwargs):
+    """See https://bazel.build/rules/lib/builtins/actions#run.resource_set."""
+    return _resource_set(MKSQUASHFS_RESOURCES["large"])
+
+def _resources_xlarge(*_args, **_kwargs):
+    """See https://bazel.build/rules/lib/builtins/actions#run.resource_set."""
+    return _resource_set(MKSQUASHFS_RESOURCES["xlarge"])
+
+_RESOURCE_SETS = {
+    "large": _resources_large,
+    "medium": _resources_medium,
+    "small": _resources_small,
+    "xlarge": _resources_xlarge,
+}
+
+# The packaged Python interpreter. It's only needed for precompile_python, to check that the .pyc files match it.
+_PY_TOOLCHAIN_TYPE = "@rules_python//python:toolchain_type"
+
+# Lets Bazel strip the configuration from output paths with --experimental_output_paths=strip, so that the same payload
+# built in different configurations has the same action keys and shares remote cache entries.
+_PATH_MAPPING = {"supports-path-mapping": "1"}
+
+def _resource_class(ctx, toolchain, files):
+    """Pick the resource class of the AppImage action.
+
+    The target's `resources` attribute takes precedence over the toolchain's. "auto" scales with the number of files,
+    which is the only reason to flatten the files depset during analysis.
+    """
+    resource_class = ctx.attr.resources or toolchain.resources
+    if resource_class != "auto":
+        return resource_class
+    num_files = len(files.to_list())
+    for candidate, max_files in _AUTO_RESOURCES_MAX_FILES:
+        if num_files < max_files:
+            return candidate
+    return "xlarge"
+
+def _uncompressed_action(pattern):
+    """Turn a glob into a mksquashfs action that stores matching files uncompressed."""
+    if not pattern or [c for c in "()@\"' \t\n" if c in pattern]:
+        fail("Unsupported pattern in uncompressed: {}".format(repr(pattern)))
+
+    # Patterns with a slash match the path inside the AppImage, others match the file name in any directory.
+    test = "pathname" if "/" in pattern else "name"
+    return "uncompressed@{}({})".format(test, pattern)
 
 def _appimage_impl(ctx):
     """Implementation of the appimage rule."""
     toolchain = ctx.toolchains["//appimage:appimage_toolchain_type"]
 
     runfile_info = collect_runfiles_info(ctx)
-    manifest_file = ctx.actions.declare_file(ctx.attr.name + ".manifest.json")
-    ctx.actions.write(manifest_file, json.encode_indent(runfile_info.manifest))
+    manifest_file = ctx.actions.declare_file(ctx.attr.name + ".manifest.txt")
+
+    # Paths in param files are rewritten by path mapping, but the contents of files written with ctx.actions.write are
+    # not. Copying the param file makes the manifest, and so the AppDir action's inputs, the same in all configurations.
+    runfile_info.manifest.use_param_file("%s", use_always = True)
+    manifest_output_args = ctx.actions.args()
+    manifest_output_args.add(manifest_file)
+    ctx.actions.run_shell(
+        mnemonic = "AppDirManifest",
+        outputs = [manifest_file],
+        arguments = [runfile_info.manifest, manifest_output_args],
+        command = 'cp "$1" "$2"',
+        execution_requirements = _PATH_MAPPING,
+    )
     apprun = make_apprun(ctx)
 
     runfiles_manifest = ctx.actions.declare_file(ctx.attr.name + ".runfiles_manifest.txt")
     pseudofile_defs = ctx.actions.declare_file(ctx.attr.name + ".pseudofile_defs.txt")
-    appdirsqfs = ctx.actions.declare_file(ctx.attr.name + ".sqfs")
+    profile = ctx.actions.declare_file(ctx.attr.name + ".profile.json")
+    size_report = ctx.actions.declare_file(ctx.attr.name + ".size_report.json")
+    stats = ctx.actions.declare_file(ctx.attr.name + ".stats.json")
+
+    # Timing of mkappdir. It differs on every run, so it is a debug output that the AppImage action doesn't consume.
+    appdir_profile = ctx.actions.declare_file(ctx.attr.name + ".appdir_profile.json")
+
+    resource_class = _resource_class(ctx, toolchain, runfile_info.files)
+    resources = MKSQUASHFS_RESOURCES[resource_class]
+
+    # mkappdir runs as persistent worker if the strategy allows it, so it gets its arguments in a param file
+    mkappdir_args = ctx.actions.args()
+    mkappdir_args.use_param_file("@%s", use_always = True)
+    mkappdir_args.set_param_file_format("multiline")
+    mkappdir_args.add("--manifest", manifest_file)
+    mkappdir_args.add("--apprun", apprun)
+    mkappdir_args.add("--runfiles_manifest", runfiles_manifest)
+    mkappdir_args.add("--jobs", resources.cpu)
+    mkappdir_args.add("--stats", stats)
+    mkappdir_args.add("--phase", appdir_profile)
+    mkappdir_outputs = []
+    if ctx.attr.excludes:
+        excluded_report = ctx.actions.declare_file(ctx.attr.name + ".excluded.json")
+        mkappdir_args.add_all(ctx.attr.excludes, before_each = "--exclude")
+        mkappdir_args.add_all(ctx.attr.includes, before_each = "--include")
+        mkappdir_args.add("--excluded_report", excluded_report)
+        mkappdir_outputs.append(excluded_report)
+    if ctx.file.startup_trace:
+        sort_file = ctx.actions.declare_file(ctx.attr.name + ".sort.txt")
+        mkappdir_args.add("--startup_trace", ctx.file.startup_trace)
+        mkappdir_args.add("--sort_file", sort_file)
+        mkappdir_outputs.append(sort_file)
+    if ctx.attr.precompile_python:
+        py_toolchain = ctx.toolchains[_PY_TOOLCHAIN_TYPE]
+        py_runtime = py_toolchain.py3_runtime if py_toolchain else None
+        version_info = getattr(py_runtime, "interpreter_version_info", None)
+        if not version_info:
+            fail("precompile_python = True needs a Python toolchain for the target platform that knows its version")
+        precompile_dir = ctx.actions.declare_directory(ctx.attr.name + ".pyc")
+        mkappdir_args.add("--precompile_dir", precompile_dir)
+        mkappdir_args.add("--python_version", "{}.{}".format(version_info.major, version_info.minor))
+        mkappdir_outputs.append(precompile_dir)
+    strip_inputs = []
+    debuginfo_outputs = []
+    if ctx.attr.strip:
+        cc_toolchain = find_cc_toolchain(ctx, mandatory = False)
+        if not cc_toolchain or not cc_toolchain.strip_executable or not cc_toolchain.objcopy_executable:
+            fail("strip = True needs a C++ toolchain with strip and objcopy for the target platform")
+        strip_dir = ctx.actions.declare_directory(ctx.attr.name + ".stripped")
+        debuginfo_dir = ctx.actions.declare_directory(ctx.attr.name + ".debug")
+        mkappdir_args.add("--strip", cc_toolchain.strip_executable)
+        mkappdir_args.add("--strip_dir", strip_dir)
+        mkappdir_args.add("--objcopy", cc_toolchain.objcopy_executable)
+        mkappdir_args.add("--debuginfo_dir", debuginfo_dir)
+        mkappdir_outputs.append(strip_dir)
+        debuginfo_outputs.append(debuginfo_dir)
+        strip_inputs.append(cc_toolchain.all_files)
+    mkappdir_args.add(pseudofile_defs)
 
     mksquashfs_args = ctx.actions.args()
     mksquashfs_args.add_all(MKSQUASHFS_ARGS)
-    mksquashfs_args.add("-processors").add(MKSQUASHFS_NUM_PROCS)
-    mksquashfs_args.add("-mem").add("%sM" % MKSQUASHFS_MEM_MB)
+    mksquashfs_args.add("-processors").add(resources.cpu)
+    mksquashfs_args.add("-mem").add("%sM" % resources.memory_mb)
+    mksquashfs_args.add_all(COMPRESSION_ARGS[ctx.attr.compression])
+    uncompressed_actions = [_uncompressed_action(pattern) for pattern in ctx.attr.uncompressed]
+    mksquashfs_args.add_all(uncompressed_actions, before_each = "-action")
     mksquashfs_args.add_all(ctx.attr.build_args)
 
+    # Outputs that are only interesting for debugging
+    debug_outputs = [runfiles_manifest, pseudofile_defs, stats, appdir_profile, profile, size_report] + mkappdir_outputs
+
+    ctx.actions.run(
+        mnemonic = "AppDir",
+        progress_message = "Preparing AppDir of %{label}",
+        inputs = depset(
+            direct = [manifest_file, apprun] + ctx.files.startup_trace,
+            transitive = [runfile_info.files] + strip_inputs,
+        ),
+        executable = ctx.executable._mkappdir,
+        arguments = [mkappdir_args],
+        outputs = [runfiles_manifest, pseudofile_defs, stats, appdir_profile] + mkappdir_outputs + debuginfo_outputs,
+        execution_requirements = _PATH_MAPPING | {
+            "requires-worker-protocol": "json",
+            "supports-workers": "1",
+        },
+    )
+
+    # All paths are passed as File objects, so that path mapping can rewrite them
+    mkappimage_args = ctx.actions.args()
+    mkappimage_args.add(pseudofile_defs)
+    mkappimage_args.add(stats)
+    mkappimage_args.add(toolchain.appimage_runtime)
+    mkappimage_args.add(ctx.outputs.executable)
+    mkappimage_args.add("1" if ctx.attr.extract_cache else "0")
+    mkappimage_args.add(profile)
+    mkappimage_args.add(size_report)
+    mkappimage_args.add(str(ctx.attr.size_budget_mb * 1024 * 1024))
+    mkappimage_args.add(sort_file if ctx.file.startup_trace else "")
+
     ctx.actions.run(
         mnemonic = "AppImage",
-        inputs = depset(direct = [manifest_file, apprun, toolchain.appimage_runtime] + runfile_info.files),
+        inputs = depset(
+            direct = [apprun, runfiles_manifest, pseudofile_defs, stats, toolchain.appimage_runtime] + mkappdir_outputs,
+            transitive = [runfile_info.files],
+        ),
         executable = ctx.executable._mkappimage,
-        arguments = [
-            manifest_file.path,
-            apprun.path,
-            runfiles_manifest.path,
-            pseudofile_defs.path,
-            appdirsqfs.path,
-            toolchain.appimage_runtime.path,
-            ctx.outputs.executable.path,
-            mksquashfs_args,
-        ],
-        outputs = [ctx.outputs.executable, runfiles_manifest, pseudofile_defs, appdirsqfs],
-        resource_set = _resources,
+        arguments = [mkappimage_args, mksquashfs_args],
+        outputs = [ctx.outputs.executable, profile, size_report],
+        resource_set = _RESOURCE_SETS[resource_class],
+        execution_requirements = _PATH_MAPPING,
+    )
+
+    # The squashfs image is only needed for debugging, so it's cut out of the AppImage in a separate action that only
+    # runs when the appimage_debug output group is requested.
+    appdirsqfs = ctx.actions.declare_file(ctx.attr.name + ".sqfs")
+    ctx.actions.run_shell(
+        mnemonic = "AppImageSqfs",
+        inputs = [ctx.outputs.executable, toolchain.appimage_runtime],
+        outputs = [appdirsqfs],
+        arguments = [toolchain.appimage_runtime.path, ctx.outputs.executable.path, appdirsqfs.path],
+        command = 'tail -c +"$(($(wc -c <"$1") + 1))" "$2" >"$3"',
     )
 
     # Take the `binary` env and add the appimage target's env on top of it
@@ -73,14 +259,82 @@ def _appimage_impl(ctx):
             runfiles = ctx.runfiles(files = [ctx.outputs.executable]),
         ),
         RunEnvironmentInfo(env),
-        OutputGroupInfo(appimage_debug = depset([manifest_file, runfiles_manifest, pseudofile_defs, appdirsqfs])),
+        OutputGroupInfo(
+            appimage_debug = depset([manifest_file] + debug_outputs + [appdirsqfs]),
+            appimage_debuginfo = depset(debuginfo_outputs),
+        ),
     ]
 
 _ATTRS = {
     "binary": attr.label(executable = True, cfg = "target"),
     "build_args": attr.string_list(),
+    "compression": attr.string(
+        default = "",
+        values = ["", "fast", "none", "small"],
+        doc = "Compressor for the SquashFS payload. `fast` (lz4) decompresses fastest, `small` (xz) gives the best " +
+              "ratio, `none` stores everything uncompressed. Defaults to gzip. Blocks that don't shrink are always " +
+              "stored uncompressed. `build_args` can override this.",
+    ),
     "data": attr.label_list(allow_files = True, doc = "Any additional data that will be made available inside the appimage"),
     "env": attr.string_dict(doc = "Runtime environment variables. See https://bazel.build/reference/be/common-definitions#common-attributes-tests"),
+    "excludes": attr.string_list(
+        doc = "Glob patterns of paths to leave out of the AppImage, e.g. `tests`, `*.pyi`, `*.a` or " +
+              "`*.dist-info/RECORD`. Patterns without `/` match file and directory names, patterns with `/` match " +
+              "the path inside the AppImage, and `*` also matches `/`. Everything inside a matching directory is " +
+              "left out as well. What was left out is listed in the `appimage_debug` output group's exclusion report.",
+    ),
+    "extract_cache": attr.bool(
+        default = False,
+        doc = "Append a digest of the SquashFS image to the AppImage, so that " +
+              "`@rules_appimage//appimage:extract_and_run_cached` can extract it once into a persistent cache " +
+              "and run it from there.",
+    ),
+    "includes": attr.string_list(
+        doc = "Glob patterns of paths to keep even though they, or a directory they're in, match `excludes`. " +
+              "The innermost match wins.",
+    ),
+    "launcher": attr.label(
+        executable = True,
+        cfg = "target",
+        doc = "Native launcher to use as AppRun instead of the default shell script, e.g. " +
+              "`@rules_appimage//appimage:native_launcher`. Starts faster but needs a C toolchain for the target platform.",
+    ),
+    "precompile_python": attr.bool(
+        default = False,
+        doc = "Compile all `.py` files into `__pycache__/*.pyc` files, so that Python doesn't need to compile them " +
+              "on every start. The AppImage is read-only, so Python can't cache them itself. The build fails if the " +
+              "Python that runs the build tools is not the same version as the target's Python toolchain.",
+    ),
+    "resources": attr.string(
+        default = "",
+        values = ["", "auto", "small", "medium", "large", "xlarge"],
+        doc = "CPU and memory used by mksquashfs and reserved for the AppImage action. " +
+              "One of `small` (1 CPU, 256 MB), `medium` (4 CPUs, 1 GB), `large` (8 CPUs, 2 GB), `xlarge` (16 CPUs, 4 GB), " +
+              "or `auto` to pick one based on the number of packaged files. `auto` flattens the runfiles during analysis, " +
+              "which slows down the analysis of large targets. Defaults to the toolchain's `resources`.",
+    ),
+    "size_budget_mb": attr.int(
+        default = 0,
+        doc = "Fail the build if the AppImage is larger than this many MiB. The error lists the directories that " +
+              "take up the most space. `0` means no limit. See also the `appimage_debug` output group's size report.",
+    ),
+    "startup_trace": attr.label(
+        allow_single_file = True,
+        doc = "Paths inside the AppImage in the order they are read at startup, one per line, as written by " +
+              "`@rules_appimage//appimage:record_startup_trace`. These files are placed first and contiguously in the " +
+              "SquashFS image, which reduces scattered reads on a cold start.",
+    ),
+    "strip": attr.bool(
+        default = False,
+        doc = "Package copies of executables and shared objects without debug info, made with the target C++ " +
+              "toolchain's `strip`. The debug info is kept in the `appimage_debuginfo` output group, laid out as " +
+              "`.build-id/xx/yyyy.debug` for debuggers and debuginfod.",
+    ),
+    "uncompressed": attr.string_list(
+        doc = "Glob patterns of files to store uncompressed, e.g. already compressed `*.whl` or `*.gz` files. " +
+              "Patterns without `/` match file names, patterns with `/` match the path inside the AppImage.",
+    ),
+    "_mkappdir": attr.label(default = "//appimage/private:mkappdir", executable = True, cfg = "exec"),
     "_mkappimage": attr.label(default = "//appimage/private:mkappimage", executable = True, cfg = "exec"),
 }
 
@@ -88,7 +342,10 @@ appimage = rule(
     implementation = _appimage_impl,
     attrs = _ATTRS,
     executable = True,
-    toolchains = ["//appimage:appimage_toolchain_type"],
+    toolchains = [
+        "//appimage:appimage_toolchain_type",
+        config_common.toolchain_type(_PY_TOOLCHAIN_TYPE, mandatory = False),
+    ] + use_cc_toolchain(mandatory = False),
     doc = """\
 Package your binary into an AppImage.
 
@@ -100,7 +357,10 @@ appimage_test = rule(
     implementation = _appimage_impl,
     attrs = _ATTRS,
     test = True,
-    toolchains = ["//appimage:appimage_toolchain_type"],
+    toolchains = [
+        "//appimage:appimage_toolchain_type",
+        config_common.toolchain_type(_PY_TOOLCHAIN_TYPE, mandatory = False),
+    ] + use_cc_toolchain(mandatory = False),
     doc = """\
 Package your test target into an AppImage.
 
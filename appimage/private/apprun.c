@@ -0,0 +1,175 @@
+// Native AppRun launcher.
+//
+// This is a drop-in replacement for the shell AppRun generated by mkapprun.bzl.
+// It does the same setup without starting a shell. The launch config is
+// appended to this binary at build time:
+//
+//   <launcher ELF> <config> <10-digit decimal length of config> "APPRUN"
+//
+// The config is a list of newline-terminated lines: the workdir (relative to
+// the directory containing AppRun), the entrypoint (relative to the workdir),
+// and then any number of KEY=VALUE environment variables.
+
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define TRAILER_MAGIC "APPRUN"
+#define TRAILER_LEN_DIGITS 10
+#define TRAILER_SIZE (TRAILER_LEN_DIGITS + sizeof(TRAILER_MAGIC) - 1)
+
+static void fail(const char *what, const char *arg) {
+  fprintf(stderr, "AppRun: %s %s\n", what, arg);
+  exit(127);
+}
+
+static void die(const char *what, const char *arg) {
+  fprintf(stderr, "AppRun: %s %s: %s\n", what, arg, strerror(errno));
+  exit(127);
+}
+
+static ssize_t pread_all(int fd, char *buf, size_t count, off_t offset) {
+  size_t done = 0;
+  while (done < count) {
+    ssize_t n = pread(fd, buf + done, count - done, offset + (off_t)done);
+    if (n < 0 && errno == EINTR)
+      continue;
+    if (n <= 0)
+      return -1;
+    done += (size_t)n;
+  }
+  return (ssize_t)done;
+}
+
+// Read the config appended to our own executable. The returned buffer is
+// NUL-terminated.
+static char *read_config(void) {
+  const char *self = "/proc/self/exe";
+  int fd = open(self, O_RDONLY | O_CLOEXEC);
+  if (fd < 0)
+    die("cannot open", self);
+  struct stat st;
+  if (fstat(fd, &st) != 0)
+    die("cannot stat", self);
+
+  char trailer[TRAILER_SIZE + 1] = {0};
+  if (st.st_size < (off_t)TRAILER_SIZE ||
+      pread_all(fd, trailer, TRAILER_SIZE, st.st_size - TRAILER_SIZE) < 0 ||
+      memcmp(trailer + TRAILER_LEN_DIGITS, TRAILER_MAGIC,
+             sizeof(TRAILER_MAGIC) - 1) != 0) {
+    fail("no launch config in", self);
+  }
+  trailer[TRAILER_LEN_DIGITS] = '\0';
+  char *end;
+  long long len = strtoll(trailer, &end, 10);
+  if (*end != '\0' || len < 0 || len > st.st_size - (off_t)TRAILER_SIZE)
+    fail("invalid launch config in", self);
+
+  char *config = malloc((size_t)len + 1);
+  if (config == NULL)
+    die("cannot allocate memory for", self);
+  if (pread_all(fd, config, (size_t)len,
+                st.st_size - (off_t)TRAILER_SIZE - len) < 0)
+    die("cannot read", self);
+  config[len] = '\0';
+  close(fd);
+  return config;
+}
+
+// Split off the next line of the config, or return NULL at the end.
+static char *next_line(char **cursor) {
+  char *line = *cursor;
+  char *nl = strchr(line, '\n');
+  if (nl == NULL)
+    return NULL;
+  *nl = '\0';
+  *cursor = nl + 1;
+  return line;
+}
+
+// Absolute path of the directory containing AppRun. Equivalent to `cd "${0%/*}"
+// && pwd` in the shell AppRun.
+static char *get_thisdir(const char *argv0) {
+  char *dir = NULL;
+  const char *slash = strrchr(argv0, '/');
+  if (slash != NULL) {
+    dir = strndup(argv0, (size_t)(slash - argv0 + 1));
+  } else {
+    char self[PATH_MAX];
+    ssize_t n = readlink("/proc/self/exe", self, sizeof(self) - 1);
+    if (n < 0)
+      die("cannot resolve", "/proc/self/exe");
+    self[n] = '\0';
+    dir = strndup(self, (size_t)(strrchr(self, '/') - self + 1));
+  }
+  if (dir == NULL)
+    die("cannot allocate memory for", argv0);
+  char *abs = realpath(dir, NULL);
+  if (abs == NULL)
+    die("cannot resolve", dir);
+  free(dir);
+  return abs;
+}
+
+int main(int argc, char **argv) {
+  (void)argc;
+  char *cursor = read_config();
+  char *workdir_rel = next_line(&cursor);
+  char *entrypoint = next_line(&cursor);
+  if (workdir_rel == NULL || entrypoint == NULL)
+    fail("invalid launch config in", "/proc/self/exe");
+
+  // Environment of the binary and the appimage target. Same as sourcing the env
+  // file in the shell AppRun.
+  for (char *line; (line = next_line(&cursor)) != NULL;) {
+    char *eq = strchr(line, '=');
+    if (eq == NULL)
+      fail("invalid environment variable in launch config:", line);
+    *eq = '\0';
+    if (setenv(line, eq + 1, 1) != 0)
+      die("cannot set", line);
+  }
+
+  // See mkapprun.bzl for why these are set.
+  const char *owd = getenv("OWD");
+  char cwd[PATH_MAX];
+  if (owd == NULL) {
+    if (getcwd(cwd, sizeof(cwd)) == NULL)
+      die("cannot get", "current working directory");
+    owd = cwd;
+  }
+  if (setenv("BUILD_WORKING_DIRECTORY", owd, 0) != 0)
+    die("cannot set", "BUILD_WORKING_DIRECTORY");
+
+  unsetenv("JAVA_RUNFILES");
+  unsetenv("RUNFILES_MANIFEST_FILE");
+  unsetenv("RUNFILES_MANIFEST_ONLY");
+  unsetenv("TEST_SRCDIR");
+
+  char *thisdir = get_thisdir(argv[0]);
+  char *workdir;
+  if (asprintf(&workdir, "%s/%s", thisdir, workdir_rel) < 0)
+    die("cannot allocate memory for", workdir_rel);
+  char *runfiles_dir =
+      strndup(workdir, (size_t)(strrchr(workdir, '/') - workdir));
+  if (runfiles_dir == NULL)
+    die("cannot allocate memory for", workdir);
+  if (setenv("RUNFILES_DIR", runfiles_dir, 1) != 0)
+    die("cannot set", "RUNFILES_DIR");
+
+  if (chdir(workdir) != 0)
+    die("cannot cd to", workdir);
+
+  char *path;
+  if (asprintf(&path, "./%s", entrypoint) < 0)
+    die("cannot allocate memory for", entrypoint);
+  argv[0] = path;
+  execv(path, argv);
+  die("cannot exec", path);
+}
@@ -0,0 +1,66 @@
+#!/bin/sh
+
+# Run an AppImage that was built with `extract_cache = True` from a persistent cache of extracted AppImages.
+#
+# Usage: extract_and_run_cached.sh <appimage> [args...]
+#
+# The AppImage is extracted once into a directory named after the digest of its squashfs image, below
+# $APPIMAGE_EXTRACT_CACHE (default: ${XDG_CACHE_HOME:-$HOME/.cache}/rules_appimage). Later runs of the same AppImage, or
+# of a copy of it, run the extracted AppRun directly. This is an alternative to --appimage-extract-and-run, which
+# extracts the whole AppImage on every run, for places where FUSE is not available.
+#
+# Anyone who can write to the cache directory can change what is run, so don't share it with untrusted users.
+
+set -eu
+
+if [ $# -lt 1 ]; then
+    echo >&2 "Usage: $0 <appimage> [args...]"
+    exit 2
+fi
+appimage="$1"
+shift
+case "$appimage" in
+/*) ;;
+*) appimage="$PWD/$appimage" ;;
+esac
+
+# See mkappimage.sh for the trailer format
+trailer="$(tail -c 87 "$appimage")"
+digest="${trailer#rules_appimage-sha256:}"
+case "$digest" in
+"$trailer" | *[!0-9a-f]*)
+    echo >&2 "$appimage was not built with extract_cache = True"
+    exit 2
+    ;;
+esac
+
+cache="${APPIMAGE_EXTRACT_CACHE:-${XDG_CACHE_HOME:-$HOME/.cache}/rules_appimage}"
+appdir="$cache/$digest"
+if [ ! -d "$appdir" ]; then
+    mkdir -p "$cache"
+    # Concurrent first runs wait for a single extraction. It is moved into place in one rename, so a crashed
+    # extraction never leaves an incomplete appdir behind.
+    exec 9>"$appdir.lock"
+    flock 9
+    if [ ! -d "$appdir" ]; then
+        tmpdir="$(mktemp -d "$appdir.tmp.XXXXXX")"
+        (
+            unset APPIMAGE_EXTRACT_AND_RUN
+            cd "$tmpdir"
+            "$appimage" --appimage-extract >/dev/null
+        ) || {
+            rm -rf "$tmpdir"
+            exit 1
+        }
+        mv "$tmpdir/squashfs-root" "$appdir"
+        rm -rf "$tmpdir"
+    fi
+    exec 9>&-
+fi
+
+# Set the same variables as the AppImage runtime
+APPIMAGE="$appimage"
+APPDIR="$appdir"
+ARGV0="$appimage"
+export APPIMAGE APPDIR ARGV0
+exec "$appdir/AppRun" "$@"
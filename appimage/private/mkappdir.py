@@ -3,18 +3,34 @@
 from __future__ import annotations
 
 import argparse
-import copy
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
 import functools
+import hashlib
+import io
+import itertools
 import json
 import os
+import posixpath
+import py_compile
 import re
-import shutil
+import resource
+import stat
+import struct
+import subprocess
 import sys
+import time
+import traceback
 from pathlib import Path
-from typing import TYPE_CHECKING, NamedTuple
+from typing import IO, TYPE_CHECKING, Any, NamedTuple, TypeVar, cast
 
 if TYPE_CHECKING:
-    from collections.abc import Sequence
+    from collections.abc import Callable, Container, Hashable, Iterable, Iterator, Mapping, Sequence
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
 
 
 class _ManifestCopy(NamedTuple):
@@ -30,38 +46,130 @@ class _ManifestLink(NamedTuple):
 class _ManifestFilesToRun(NamedTuple):
     repo_mapping_basename: str
     runfiles_manifest_short_path: str
+    # The dir that runfiles' short paths are relative to, e.g. "tests/test_py.runfiles/_main"
+    reference_dir: str = "."
 
 
-class _ManifestData(NamedTuple):
-    empty_files: list[str]
-    files: list[_ManifestCopy]
-    files_to_run: _ManifestFilesToRun
-    symlinks: list[_ManifestLink]
-    relative_symlinks: list[_ManifestLink]
-    tree_artifacts: list[_ManifestCopy]
-
-    @classmethod
-    def from_json(cls, data: str) -> _ManifestData:
-        data_dict = json.loads(data)
-        return cls(
-            empty_files=data_dict.get("empty_files", []),
-            files=[_ManifestCopy(**entry) for entry in data_dict.get("files", [])],
-            symlinks=[_ManifestLink(**entry) for entry in data_dict.get("symlinks", [])],
-            relative_symlinks=[_ManifestLink(**entry) for entry in data_dict.get("relative_symlinks", [])],
-            files_to_run=_ManifestFilesToRun(**data_dict["files_to_run"]),
-            tree_artifacts=[_ManifestCopy(**entry) for entry in data_dict.get("tree_artifacts", [])],
-        )
+class _Manifest(NamedTuple):
+    """The manifest written by the appimage rule, describing what goes into the AppDir.
+
+    The manifest has one record per line, with tab-separated fields. The first field is the kind of record:
+      "r <repo_mapping_basename> <runfiles_manifest_short_path> <reference_dir>"
+                                                                    the binary's files_to_run
+      "e <dst>"                                                     create an empty file
+      "f <src> <dst>"                                               copy a file
+      "l <linkname> <target>"                                       create a symlink
+      "t <src> <dst>"                                               copy the contents of a tree artifact
+      "x <src> <dst>"                                               a file that matched the excludes during analysis
+
+    Most records are generated from runfiles' short paths by Bazel during execution, so dst, linkname and target are
+    relative to reference_dir. They are returned as normalized paths inside the AppDir.
+
+    Records are streamed from disk each time they are iterated instead of being held in memory.
+    """
+
+    path: Path
+
+    def _records(self, kind: str) -> Iterator[list[str]]:
+        with self.path.open() as f:
+            for line in f:
+                record = line.rstrip("\n").split("\t")
+                if record[0] == kind:
+                    yield record[1:]
+
+    def _appdir_paths(self) -> Callable[[str], str]:
+        """Return a function that turns a path relative to reference_dir into a normalized path inside the AppDir."""
+        reference_dir = self.files_to_run().reference_dir
+        return lambda path: posixpath.normpath(posixpath.join(reference_dir, path))
+
+    def files_to_run(self) -> _ManifestFilesToRun:
+        return _ManifestFilesToRun(*next(self._records("r")))
+
+    def empty_files(self) -> Iterator[str]:
+        appdir_path = self._appdir_paths()
+        for (dst,) in self._records("e"):
+            yield appdir_path(dst)
+
+    def files(self) -> Iterator[_ManifestCopy]:
+        appdir_path = self._appdir_paths()
+        for src, dst in self._records("f"):
+            yield _ManifestCopy(dst=appdir_path(dst), src=src)
+
+    def symlinks(self) -> Iterator[_ManifestLink]:
+        appdir_path = self._appdir_paths()
+        for linkname, target in self._records("l"):
+            yield _ManifestLink(linkname=appdir_path(linkname), target=appdir_path(target))
+
+    def tree_artifacts(self) -> Iterator[_ManifestCopy]:
+        appdir_path = self._appdir_paths()
+        for src, dst in self._records("t"):
+            yield _ManifestCopy(dst=appdir_path(dst), src=src)
+
+    def excluded_files(self) -> Iterator[_ManifestCopy]:
+        appdir_path = self._appdir_paths()
+        for src, dst in self._records("x"):
+            yield _ManifestCopy(dst=appdir_path(dst), src=src)
+
+
+def _lstat_identity(path: Path | str) -> tuple[Hashable, ...]:
+    """Identify what is at path without following symlinks, including the target of a symlink."""
+    path_stat = Path(path).lstat()
+    link = Path(path).readlink().as_posix() if stat.S_ISLNK(path_stat.st_mode) else None
+    return (path_stat.st_dev, path_stat.st_ino, path_stat.st_mtime_ns, path_stat.st_size, link)
+
+
+class _InputCache:
+    """Results of probing input files, kept across the requests of a persistent worker.
+
+    A result is only reused while Bazel reports the same digest for the probed path and the path's lstat and symlink
+    target are unchanged. Bazel's digest of a symlink is that of its target's contents, so a symlink that is retargeted
+    to a file with the same contents is probed again, too.
+    Outside of a worker, nothing is cached, so that memory use doesn't grow with the number of inputs.
+    """
+
+    def __init__(self) -> None:
+        self._digests: dict[str, str] | None = None
+        self._results: dict[tuple[Hashable, ...], tuple[tuple[Hashable, ...], Any]] = {}
+
+    def start_request(self, inputs: Iterable[Mapping[str, str]]) -> None:
+        """Drop the results for inputs that changed or went away since the previous request."""
+        digests = {entry["path"]: entry.get("digest", "") for entry in inputs}
+        old_digests = self._digests or {}
+        unchanged = {path for path, digest in digests.items() if digest and old_digests.get(path) == digest}
+        self._results = {key: result for key, result in self._results.items() if key[1] in unchanged}
+        self._digests = {path: digest for path, digest in digests.items() if digest}
+
+    def __call__(self, fn: Callable[..., _R]) -> Callable[..., _R]:
+        """Cache fn, whose first argument is the probed path."""
+
+        @functools.wraps(fn)
+        def wrapper(path: Path | str, *args: Any) -> _R:
+            if self._digests is None or str(path) not in self._digests:
+                return fn(path, *args)
+            key = (fn.__name__, str(path), args)
+            try:
+                identity = _lstat_identity(path)
+            except FileNotFoundError:
+                return fn(path, *args)
+            cached = self._results.get(key)
+            if cached is not None and cached[0] == identity:
+                return cast("_R", cached[1])
+            result = fn(path, *args)
+            self._results[key] = (identity, result)
+            return result
+
+        return wrapper
+
+
+_input_cache = _InputCache()
 
 
 def relative_path(target: Path, origin: Path) -> Path:
-    """Return path of target relative to origin."""
-    try:
-        return target.resolve().relative_to(origin.resolve())
-    except ValueError:  # target does not start with origin
-        if origin.parent == origin:
-            # We've reached "/" or "." - the target will now always be relative
-            return target
-        return Path("..").joinpath(relative_path(target, origin.parent))
+    """Return path of target relative to origin.
+
+    Both paths are locations inside the AppDir, so this is a purely lexical operation that does not look at the disk.
+    """
+    return Path(os.path.relpath(target, origin))
 
 
 @functools.lru_cache
@@ -133,170 +241,253 @@ def get_output_base() -> str:
 
 
 def is_inside_bazel_cache(path: Path) -> bool:
-    """Check whether a path is inside the Bazel cache."""
-    return os.fspath(path).startswith(get_output_base())
-
+    """Check whether a path is inside the Bazel cache or the execroot that the action runs in.
 
-def get_all_parent_dirs(path: Path | str) -> list[Path]:
-    path = Path(path)
-    parts = path.parts if path.is_dir() else path.parts[:-1]
-    return [Path(*parts[: i + 1]) for i in range(len(parts))]
+    The execroot is the working directory, so the second check doesn't depend on the layout of the output base. It also
+    holds on remote executors and with path mapping, where get_output_base can only guess.
+    """
+    execroot = Path.cwd()
+    return os.fspath(path).startswith(get_output_base()) or Path(path) == execroot or execroot in Path(path).parents
 
 
-def to_pseudofile_def_lines(src: Path, dst: Path, preserve_symlinks: bool) -> dict[str, str]:
-    """Return a pseudo-file definition line for a file or directory.
+def _parallel_map(fn: Callable[[_T], _R], items: Iterable[_T], jobs: int) -> Iterator[_R]:
+    """Lazily map fn over items with up to `jobs` threads, yielding the results in the order of items.
 
-    See https://github.com/plougher/squashfs-tools/blob/d8cb82d/USAGE#L753
-    and https://github.com/plougher/squashfs-tools/blob/d8cb82d/examples/pseudo-file.example
-
-    Pseudo file definition formats used here:
-    "filename d mode uid gid"               create a directory
-    "filename f mode uid gid command"       create file from stdout of command
-    "filename h filename"                   create file from copy (hard-link) of filename
-    "filename s mode uid gid symlink"       create a symbolic link (mode is ignored)
+    This is meant for filesystem probes, which release the GIL and can be slow on network or lazily-fetching
+    filesystems. The results are in input order, so the output stays deterministic regardless of `jobs`.
+    Only a bounded number of items is in flight at any time, so items may be a stream.
     """
-    operations = {dir.as_posix(): "d 755 0 0" for dir in get_all_parent_dirs(dst)}
-    if (
-        src.is_symlink()
-        and (preserve_symlinks or not src.readlink().exists())
-        and not is_inside_bazel_cache(src.readlink())
-    ):
-        operations[dst.as_posix()] = f"s 0 0 0 {src.readlink()}"
-    elif src.is_file():
-        operations[dst.as_posix()] = f'h "{src}"'
-    elif src.is_dir():
-        operations[dst.as_posix()] = f"d {src.lstat().st_mode & 0o777:o} 0 0"
-    elif not src.exists():
-        raise FileNotFoundError(f"{src=} does not exist")
-    else:
-        raise NotImplementedError(f"Cannot handle {src}")
+    if jobs <= 1:
+        yield from map(fn, items)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending: collections.deque[concurrent.futures.Future[_R]] = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 64 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _new_parent_dirs(path: str, known: Container[str]) -> Iterator[str]:
+    """Yield the parent dirs of path, innermost first, up to (and excluding) the first one that is already known.
+
+    If every known path's parents are known as well, this visits each directory only once over all calls.
+    """
+    parent = posixpath.dirname(path)
+    while parent and parent not in known:
+        yield parent
+        grandparent = posixpath.dirname(parent)
+        if grandparent == parent:  # reached "/"
+            break
+        parent = grandparent
 
-    return operations
 
+def _add_pseudofile_def(operations: dict[str, str], dst: str, definition: str) -> None:
+    """Add a pseudo-file definition and make sure that all parent directories of dst are created as well."""
+    for dir in _new_parent_dirs(dst, operations):
+        operations[dir] = "d 755 0 0"
+    operations[dst] = definition
 
-def copy_file_or_dir(src: Path, dst: Path, preserve_symlinks: bool) -> dict[str, str]:
-    """Copy a file or dir from src to dst."""
-    if not src.is_dir():
-        return to_pseudofile_def_lines(src, dst, preserve_symlinks)
 
-    operations: dict[str, str] = {}
+@_input_cache
+def _pseudofile_def(src: Path, preserve_symlinks: bool) -> str:
+    """Return the pseudo-file definition (without the filename) for a file, dir, or symlink.
 
-    # Scan and recreate symlinks manually
-    links = {link for link in src.rglob("*") if link.is_symlink()}
-    for link in links:
-        operations.update(to_pseudofile_def_lines(link, dst / link.relative_to(src), preserve_symlinks))
-
-    copies: dict[str, str] = {}
-    shutil.copytree(
-        src,
-        dst,
-        symlinks=preserve_symlinks,
-        ignore=lambda dir, names: [f for f in names if Path(dir) / f in links],
-        copy_function=lambda src, dst: copies.setdefault(dst, src),
-        ignore_dangling_symlinks=False,
-        dirs_exist_ok=True,
-    )
-    for dst_, src_ in copies.items():
-        operations.update(to_pseudofile_def_lines(Path(src_), Path(dst_), preserve_symlinks))
+    The file type is determined with a single lstat call, plus one readlink and stat for symlinks.
+    """
+    try:
+        src_stat = src.lstat()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"{src=} does not exist") from None
+    mode = src_stat.st_mode
+    if stat.S_ISLNK(mode):
+        link = src.readlink()
+        if (preserve_symlinks or not link.exists()) and not is_inside_bazel_cache(link):
+            return f"s 0 0 0 {link}"
+        try:
+            mode = src.stat().st_mode
+        except FileNotFoundError:
+            raise FileNotFoundError(f"{src=} does not exist") from None
+    if stat.S_ISREG(mode):
+        return f'h "{src}"'
+    if stat.S_ISDIR(mode):
+        return f"d {src_stat.st_mode & 0o777:o} 0 0"
+    raise NotImplementedError(f"Cannot handle {src}")
+
+
+def _file_pseudofile_def(src: Path, preserve_symlinks: bool) -> str | None:
+    """Return the pseudo-file definition for src, or None if src is a directory whose contents need to be copied."""
+    definition = _pseudofile_def(src, preserve_symlinks)
+    if definition.startswith("h ") or (definition.startswith("s ") and not src.is_dir()):
+        return definition
+    return None
+
+
+def _walk_dir(src: str) -> Iterator[os.DirEntry[str]]:
+    """Yield everything below dir src but the dirs themselves, without following symlinks.
+
+    The entries carry the file type from the directory listing, so telling files and dirs apart doesn't need a stat.
+    """
+    pending = [src]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    yield entry
+
+
+def _copy_dir(operations: dict[str, str], src: Path, dst: Path, preserve_symlinks: bool, jobs: int) -> None:
+    """Add pseudo-file definitions to copy the contents of dir src to dst."""
+    src_prefix_len = len(os.fspath(src)) + 1
+    dst_prefix = dst.as_posix()
+    links = []
+    for entry in _walk_dir(os.fspath(src)):
+        entry_dst = posixpath.join(dst_prefix, entry.path[src_prefix_len:])
+        if entry.is_symlink():
+            links.append((entry_dst, Path(entry.path)))
+        elif entry.is_file(follow_symlinks=False):
+            _add_pseudofile_def(operations, entry_dst, f'h "{entry.path}"')
+        else:
+            raise NotImplementedError(f"Cannot handle {entry.path}")
 
-    return operations
+    # Symlinks need a readlink, and maybe a stat of their target, so they are probed in parallel
+    link_defs = _parallel_map(lambda link: _pseudofile_def(link[1], preserve_symlinks), links, jobs)
+    for (link_dst, _), definition in zip(links, link_defs):
+        _add_pseudofile_def(operations, link_dst, definition)
 
 
-def _move_relative_symlinks_in_files_to_their_own_section(manifest_data: _ManifestData) -> _ManifestData:
-    """Check if a file is a _relative_ symlink and if so, move it to a new relative_symlinks section."""
-    new_manifest_data = copy.deepcopy(manifest_data)
-    new_manifest_data.files.clear()
-    new_manifest_data.relative_symlinks.clear()
-    files_that_will_exist = {entry.dst for entry in manifest_data.files}
+def copy_file_or_dir(operations: dict[str, str], src: Path, dst: Path, preserve_symlinks: bool, jobs: int = 1) -> None:
+    """Add pseudo-file definitions to copy a file or dir from src to dst."""
+    definition = _file_pseudofile_def(src, preserve_symlinks)
+    if definition is None:
+        _copy_dir(operations, src, dst, preserve_symlinks, jobs)
+    else:
+        _add_pseudofile_def(operations, dst.as_posix(), definition)
+
+
+def _relative_symlink_target(
+    entry: _ManifestCopy, files_that_will_exist: set[str], dirs_that_will_exist: set[str]
+) -> str | None:
+    """Return the target if the entry should become a relative symlink, or None if it should be copied as-is."""
+    src = Path(entry.src)
+
+    if not src.is_symlink():
+        # This is not a symlink. We want to copy that regular file (or dir!) as-is.
+        return None
+
+    target = src.readlink()
+
+    while target.is_symlink() and is_inside_bazel_cache(target):
+        # This is a symlink residing inside the Bazel cache. Follow it to find where it actually points.
+        # Example: src "external/rules_appimage_python_x86_64-unknown-linux-gnu/bin/2to3" is a symlink with target
+        # "/home/user/.cache/bazel/_bazel_user/a5a...2f3/execroot/rules_appimage/external/rules_appimage_python_x86_
+        # 64-unknown-linux-gnu/bin/2to3" (in Bazel 6) or "/tmp/bazel-source-roots/2/bin/2to3" (in Bazel 7), which
+        # itself is a symlink pointing at "2to3-3.11".
+        # Loop until we find a symlink chain end or a file that is not inside the Bazel cache.
+        # Repository rules may have generated a symlink chain that should be be preserved.
+        # Example: libfoo.so -> libfoo.so.1 -> libfoo.so.1.0.
+        target = target.readlink()
+
+    if target.is_symlink():
+        linkdst = target.readlink()
+    else:
+        if not target.is_absolute():
+            # This was a relative symlink that we resolved in the last step already.
+            linkdst = target
+        else:
+            # The src is a symlink pointing to the a regular file in the Bazel cache.
+            return None
+
+    if linkdst.is_absolute():
+        # Absolute symlinks are ok to keep in the files section because we are going to resolve them before copying.
+        # Commonly this happens with source files that are symlinks from the sandbox to the actual source checkout.
+        return None
+    # This is a relative symlink. Let's move it out of the files section and into the relative_symlinks section.
+    # We do this to maintain the existing symlink structure and to prevent the linked file to be copied twice
+    # (although squashfs would deduplicate it).
+    # Note that the link target may _not_ be reachable if it is not declared as input itself.
+    # Users need to ensure that whatever shall be available at runtime is properly declared as data dependency.
+    full_linkdest = posixpath.normpath((Path(entry.dst).parent / linkdst).as_posix())
+    if Path(entry.src).is_dir():
+        will_exist = full_linkdest in dirs_that_will_exist
+    else:
+        will_exist = full_linkdest in files_that_will_exist
+    is_supposed_to_be_dangling = not Path(entry.src).exists()
+    if not will_exist and not is_supposed_to_be_dangling:
+        # Would create a symlink that points to a file or dir which will not exist in the AppDir.
+        # This can happen in situations where
+        # .../foo.runfiles/_main/_solib_k8/_U_A_A_Umain~_Urepo_Urules~foo_S_S_Clibfoo.so___Ulib/libfoo.so
+        # is a symlink pointing to "libfoo.so.12" but which will not exist in the same dir but instead lives in
+        # .../foo.runfiles/_main/_solib_k8/_U_A_A_Umain~_Urepo_Urules~foo_S_S_Clibfoo.so.12___Ulib/libfoo.so.12
+        # For now we just don't create a symlink but copy the resolved file instead. mksquashfs will deduplicate
+        # it so no additional storage is needed regardless of file size (unless extracted).
+        # The downside is that the symlink structure will not look the same as in the source.
+        return None
+    # Create the entry as relative symlink
+    return os.fspath(linkdst)
+
+
+def _move_relative_symlinks_in_files_to_their_own_section(
+    files: Iterable[_ManifestCopy],
+    files_that_will_exist: set[str],
+    relative_symlinks: list[_ManifestLink],
+    jobs: int,
+) -> Iterator[_ManifestCopy]:
+    """Check if a file is a _relative_ symlink and if so, move it to relative_symlinks. Yield all other files."""
     dirs_that_will_exist: set[str] = set()
     for file in files_that_will_exist:
-        dirs_that_will_exist.update(map(str, get_all_parent_dirs(file)))
+        dirs_that_will_exist.update(list(_new_parent_dirs(file, dirs_that_will_exist)))
 
-    for entry in manifest_data.files:
-        src = Path(entry.src)
-
-        if not src.is_symlink():
-            # This is not a symlink. We want to copy that regular file (or dir!) as-is.
-            new_manifest_data.files.append(entry)
-            continue
+    def get_target(entry: _ManifestCopy) -> tuple[_ManifestCopy, str | None]:
+        return entry, _relative_symlink_target(entry, files_that_will_exist, dirs_that_will_exist)
 
-        target = src.readlink()
-
-        while target.is_symlink() and is_inside_bazel_cache(target):
-            # This is a symlink residing inside the Bazel cache. Follow it to find where it actually points.
-            # Example: src "external/rules_appimage_python_x86_64-unknown-linux-gnu/bin/2to3" is a symlink with target
-            # "/home/user/.cache/bazel/_bazel_user/a5a...2f3/execroot/rules_appimage/external/rules_appimage_python_x86_
-            # 64-unknown-linux-gnu/bin/2to3" (in Bazel 6) or "/tmp/bazel-source-roots/2/bin/2to3" (in Bazel 7), which
-            # itself is a symlink pointing at "2to3-3.11".
-            # Loop until we find a symlink chain end or a file that is not inside the Bazel cache.
-            # Repository rules may have generated a symlink chain that should be be preserved.
-            # Example: libfoo.so -> libfoo.so.1 -> libfoo.so.1.0.
-            target = target.readlink()
-
-        if target.is_symlink():
-            linkdst = target.readlink()
+    for entry, target in _parallel_map(get_target, files, jobs):
+        if target is None:
+            yield entry
         else:
-            if not target.is_absolute():
-                # This was a relative symlink that we resolved in the last step already.
-                linkdst = target
-            else:
-                # The src is a symlink pointing to the a regular file in the Bazel cache.
-                new_manifest_data.files.append(entry)
-                continue
+            relative_symlinks.append(_ManifestLink(linkname=entry.dst, target=target))
 
-        if linkdst.is_absolute():
-            # Absolute symlinks are ok to keep in the files section because we are going to resolve them before copying.
-            # Commonly this happens with source files that are symlinks from the sandbox to the actual source checkout.
-            new_manifest_data.files.append(entry)
-        else:
-            # This is a relative symlink. Let's move it out of the files section and into the relative_symlinks section.
-            # We do this to maintain the existing symlink structure and to prevent the linked file to be copied twice
-            # (although squashfs would deduplicate it).
-            # Note that the link target may _not_ be reachable if it is not declared as input itself.
-            # Users need to ensure that whatever shall be available at runtime is properly declared as data dependency.
-            full_linkdest = (Path(entry.dst).parent / linkdst).as_posix()
-            if Path(entry.src).is_dir():
-                will_exist = os.path.normpath(full_linkdest) in dirs_that_will_exist
-            else:
-                will_exist = full_linkdest in files_that_will_exist
-            is_supposed_to_be_dangling = not Path(entry.src).exists()
-            if not will_exist and not is_supposed_to_be_dangling:
-                # Would create a symlink that points to a file or dir which will not exist in the AppDir.
-                # This can happen in situations where
-                # .../foo.runfiles/_main/_solib_k8/_U_A_A_Umain~_Urepo_Urules~foo_S_S_Clibfoo.so___Ulib/libfoo.so
-                # is a symlink pointing to "libfoo.so.12" but which will not exist in the same dir but instead lives in
-                # .../foo.runfiles/_main/_solib_k8/_U_A_A_Umain~_Urepo_Urules~foo_S_S_Clibfoo.so.12___Ulib/libfoo.so.12
-                # For now we just don't create a symlink but copy the resolved file instead. mksquashfs will deduplicate
-                # it so no additional storage is needed regardless of file size (unless extracted).
-                # The downside is that the symlink structure will not look the same as in the source.
-                new_manifest_data.files.append(entry)
-            else:
-                # Create the entry as relative symlink
-                new_manifest_data.relative_symlinks.append(_ManifestLink(linkname=entry.dst, target=os.fspath(linkdst)))
-
-    return new_manifest_data
-
-
-def _prevent_duplicate_dsts_with_diverging_srcs(manifest_data: _ManifestData) -> _ManifestData:
+
+@_input_cache
+def _file_digest(path: str) -> bytes:
+    """Return the sha256 digest of a file, reading it in chunks to keep memory usage flat for large files."""
+    digest = hashlib.sha256()
+    with Path(path).open("rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _have_same_contents(src: str, other_src: str) -> bool:
+    """Check whether two files have the same contents, reading them only if it can't be decided from their stat."""
+    src_stat = Path(src).stat()
+    other_stat = Path(other_src).stat()
+    if os.path.samestat(src_stat, other_stat):
+        return True
+    if src_stat.st_size != other_stat.st_size:
+        return False
+    return _file_digest(src) == _file_digest(other_src)
+
+
+def _prevent_duplicate_dsts_with_diverging_srcs(files: Iterable[_ManifestCopy]) -> Iterator[_ManifestCopy]:
     """Remove duplicate dsts with in the manifest and fail if the srcs would have diverging contents."""
-    new_manifest_data = copy.deepcopy(manifest_data)
-    new_manifest_data.files.clear()
     dst_to_src: dict[str, str] = {}
-    for file in manifest_data.files:
+    for file in files:
         if file.dst not in dst_to_src:
             dst_to_src[file.dst] = file.src
-            new_manifest_data.files.append(file)
+            yield file
         else:
-            this_src = Path(file.src).read_bytes()
-            other_src = Path(dst_to_src[file.dst]).read_bytes()
-            if this_src != other_src:
+            if not _have_same_contents(file.src, dst_to_src[file.dst]):
                 # this is likely a runfile of a transitioned binary that's also present in untransitioned form.
                 # We shouldn't try to overwrite it because generated files are read-only.
                 raise NotImplementedError(f"Got more than one {file.dst=} with different contents")
-    return new_manifest_data
 
 
-def make_appdir_pseudofile_defs(manifest: Path, runfiles_manifest: Path) -> dict[str, str]:
+def make_appdir_pseudofile_defs(manifest: Path, runfiles_manifest: Path, jobs: int = 1) -> dict[str, str]:
     """Make the AppDir that will be squashfs'd into the AppImage.
 
     Note that the [AppImage Type2 Spec][appimage-spec] specifies that the contained [AppDir][appdir-spec] may contain a
@@ -307,38 +498,47 @@ def make_appdir_pseudofile_defs(manifest: Path, runfiles_manifest: Path) -> dict
     [desktop-spec]: https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html
     [appimaged]: https://docs.appimage.org/user-guide/run-appimages.html#integrating-appimages-into-the-desktop
     """
-    manifest_data = _ManifestData.from_json(manifest.read_text())
-    manifest_data = _move_relative_symlinks_in_files_to_their_own_section(manifest_data)
-    manifest_data = _prevent_duplicate_dsts_with_diverging_srcs(manifest_data)
+    manifest_data = _Manifest(manifest)
+    files_to_run = manifest_data.files_to_run()
+
+    # The files are processed as a stream of stages. Only the set of dsts and the relative symlinks are kept in memory.
+    files_that_will_exist = {file.dst for file in manifest_data.files()}
+    relative_symlinks: list[_ManifestLink] = []
+    files = _move_relative_symlinks_in_files_to_their_own_section(
+        manifest_data.files(), files_that_will_exist, relative_symlinks, jobs
+    )
+    files = _prevent_duplicate_dsts_with_diverging_srcs(files)
 
     # Generate a runfiles_manifest (target.runfiles/MANIFEST file) that contains nothing but the pointer to the
     # "_repo_mapping" runfile. This is required by the rules_cc runfiles library to find the target.repo_mapping file.
     # We can not use the original MANIFEST file as generated by Bazel as it contains absolute paths that will break
     # when the Appimage is moved to another machine or container.
-    runfiles_manifest.write_text(f"_repo_mapping ../../{manifest_data.files_to_run.repo_mapping_basename}\n")
-    runfiles_manifest_dst = manifest_data.files_to_run.runfiles_manifest_short_path
-    manifest_data.files.append(_ManifestCopy(src=runfiles_manifest.as_posix(), dst=runfiles_manifest_dst))
+    runfiles_manifest.write_text(f"_repo_mapping ../../{files_to_run.repo_mapping_basename}\n")
+    runfiles_manifest_dst = files_to_run.runfiles_manifest_short_path
+    files = itertools.chain(files, [_ManifestCopy(src=runfiles_manifest.as_posix(), dst=runfiles_manifest_dst)])
 
     operations: dict[str, str] = {}
 
-    for empty_file in manifest_data.empty_files:
+    for empty_file in manifest_data.empty_files():
         # example entry: "tests/test_py.runfiles/__init__.py"
-        for dir in get_all_parent_dirs(empty_file):
-            operations[dir.as_posix()] = "d 755 0 0"
-        operations[empty_file] = "f 755 0 0 true"
+        _add_pseudofile_def(operations, empty_file, "f 755 0 0 true")
+
+    def get_definition(file: _ManifestCopy) -> tuple[_ManifestCopy, str | None]:
+        return file, _file_pseudofile_def(Path(file.src), preserve_symlinks=True)
 
-    for file in manifest_data.files:
+    for file, definition in _parallel_map(get_definition, files, jobs):
         # example entry: {"dst": "tests/test_py.runfiles/_main/tests/data.txt", "src": "tests/data.txt"}
-        operations.update(copy_file_or_dir(Path(file.src), Path(file.dst), preserve_symlinks=True))
+        if definition is None:
+            _copy_dir(operations, Path(file.src), Path(file.dst), preserve_symlinks=True, jobs=jobs)
+        else:
+            _add_pseudofile_def(operations, Path(file.dst).as_posix(), definition)
 
-    for link in manifest_data.symlinks:
+    for link in manifest_data.symlinks():
         # example entry: {"linkname": "tests/test_py", "target": "tests/test_py.runfiles/_main/tests/test_py"}
         # example entry: {"linkname":
-        # "tests/test_py.runfiles/_main/../rules_python~0.27.1~python~python_3_11_x86_64-unknown-linux-gnu/bin/python3",
+        # "tests/test_py.runfiles/rules_python~0.27.1~python~python_3_11_x86_64-unknown-linux-gnu/bin/python3",
         # "target": "python3.11"}
         linkfile = Path(link.linkname)
-        for dir in get_all_parent_dirs(linkfile):
-            operations[dir.as_posix()] = "d 755 0 0"
         target = Path(link.target)
         if target.is_absolute():
             # We keep absolute symlinks as is, but make no effort to copy the target into the runfiles as well.
@@ -347,21 +547,21 @@ def make_appdir_pseudofile_defs(manifest: Path, runfiles_manifest: Path) -> dict
         else:
             # Adapt relative symlinks to point relative to the new linkfile location
             target = relative_path(target, linkfile.parent)
-        operations[linkfile.as_posix()] = f"s 0 0 0 {target}"
+        _add_pseudofile_def(operations, linkfile.as_posix(), f"s 0 0 0 {target}")
 
-    for link in manifest_data.relative_symlinks:
+    for link in relative_symlinks:
         # example entry: {"linkname":
-        # "tests/test_py.runfiles/_main/../rules_python~0.27.1~python~python_3_11_x86_64-unknown-linux-gnu/bin/python3",
+        # "tests/test_py.runfiles/rules_python~0.27.1~python~python_3_11_x86_64-unknown-linux-gnu/bin/python3",
         # "target": "python3.11"}
-        for dir in get_all_parent_dirs(link.linkname):
-            operations[dir.as_posix()] = "d 755 0 0"
-        operations[link.linkname] = f"s 0 0 0 {link.target}"
+        _add_pseudofile_def(operations, link.linkname, f"s 0 0 0 {link.target}")
 
-    for tree_artifact in manifest_data.tree_artifacts:
+    for tree_artifact in manifest_data.tree_artifacts():
         # example entry:
-        # {'dst': 'test.runfiles/_main/../rules_pycross~~lock_repos~pdm_deps/_lock/humanize@4.9.0',
+        # {'dst': 'test.runfiles/rules_pycross~~lock_repos~pdm_deps/_lock/humanize@4.9.0',
         # 'src': 'bazel-out/k8-fastbuild/bin/external/rules_pycross~~lock_repos~pdm_deps/_lock/humanize@4.9.0'}
-        operations.update(copy_file_or_dir(Path(tree_artifact.src), Path(tree_artifact.dst), preserve_symlinks=False))
+        copy_file_or_dir(
+            operations, Path(tree_artifact.src), Path(tree_artifact.dst), preserve_symlinks=False, jobs=jobs
+        )
 
     # Must not have `..` in file names: https://github.com/plougher/squashfs-tools/blob/4.6.1/squashfs-tools/unsquash-1.c#L377
     operations = {os.path.normpath(f): v for f, v in operations.items()}
@@ -369,9 +569,331 @@ def make_appdir_pseudofile_defs(manifest: Path, runfiles_manifest: Path) -> dict
     return operations
 
 
-def write_appdir_pseudofile_defs(manifest: Path, apprun: Path, runfiles_manifest: Path, output: Path) -> None:
-    """Write a mksquashfs pf file representing the AppDir."""
-    pseudofile_defs = make_appdir_pseudofile_defs(manifest, runfiles_manifest)
+def _glob_matcher(patterns: Sequence[str]) -> Callable[[str], bool]:
+    """Return a function that checks whether a path inside the AppDir matches any of the glob patterns.
+
+    Patterns without `/` match the file name, patterns with `/` match the whole path. `*` also matches `/`.
+    """
+    name_regex = "|".join(fnmatch.translate(pattern) for pattern in patterns if "/" not in pattern)
+    path_regex = "|".join(fnmatch.translate(pattern) for pattern in patterns if "/" in pattern)
+    name_match = re.compile(name_regex).match if name_regex else lambda _: None
+    path_match = re.compile(path_regex).match if path_regex else lambda _: None
+    return lambda path: bool(name_match(posixpath.basename(path)) or path_match(path))
+
+
+def exclude_pseudofile_defs(
+    operations: dict[str, str], excludes: Sequence[str], includes: Sequence[str]
+) -> dict[str, str]:
+    """Remove the entries that match excludes but not includes from the AppDir and return them.
+
+    An entry matches if it or one of its parent directories matches. The innermost match wins, so includes can keep
+    files or directories inside an excluded directory. Parent directories of entries that are kept are kept as well.
+    """
+    exclude = _glob_matcher(excludes)
+    include = _glob_matcher(includes)
+
+    @functools.cache
+    def is_excluded(path: str) -> bool:
+        if include(path):
+            return False
+        if exclude(path):
+            return True
+        parent = posixpath.dirname(path)
+        return is_excluded(parent) if parent else False
+
+    excluded = {dst for dst in operations if is_excluded(dst)}
+    needed_dirs: set[str] = set()
+    for dst in operations.keys() - excluded:
+        needed_dirs.update(list(_new_parent_dirs(dst, needed_dirs)))
+    return {dst: operations.pop(dst) for dst in sorted(excluded - needed_dirs)}
+
+
+def make_exclusion_report(excluded: dict[str, str], operations: dict[str, str]) -> dict[str, Any]:
+    """Summarize what was excluded from the AppDir, and list the symlinks that point to excluded entries."""
+    srcs = [definition[2:].strip('"') for definition in excluded.values() if definition.startswith("h ")]
+    dangling_symlinks = sorted(
+        dst
+        for dst, definition in operations.items()
+        if definition.startswith("s ")
+        and posixpath.normpath(posixpath.join(posixpath.dirname(dst), definition.split(" ", 4)[4])) in excluded
+    )
+    return {
+        "files": sum(1 for definition in excluded.values() if definition[0] in "hf"),
+        "bytes": sum(Path(src).stat().st_size for src in srcs),
+        "dangling_symlinks": dangling_symlinks,
+        "excluded": list(excluded),
+    }
+
+
+def _compile_pyc(src_pyc_and_dst: tuple[str, str, str]) -> None:
+    src, pyc, dst = src_pyc_and_dst
+    Path(pyc).parent.mkdir(parents=True, exist_ok=True)
+    # dfile keeps the sandbox path of src out of the code objects, so that the .pyc files are reproducible
+    invalidation_mode = py_compile.PycInvalidationMode.UNCHECKED_HASH
+    py_compile.compile(src, cfile=pyc, dfile=dst, doraise=True, invalidation_mode=invalidation_mode, quiet=1)
+
+
+def precompile_python(operations: dict[str, str], output_dir: Path, python_version: str, jobs: int = 1) -> None:
+    """Compile all .py files in the AppDir and add the .pyc files to the matching __pycache__ dirs.
+
+    The AppDir is read-only at runtime, so Python can't cache bytecode itself. The .pyc files are only valid for the
+    Python version that runs this, so it must match python_version, the "major.minor" version of the packaged
+    interpreter. They use unchecked hash-based invalidation, so that they are deterministic and are used without
+    looking at the source file's mtime.
+    """
+    own_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    if python_version != own_version:
+        msg = (
+            f"Can't precompile for Python {python_version} with Python {own_version}. "
+            "Use the same Python version for the exec and the target platform, or turn off precompile_python."
+        )
+        raise ValueError(msg)
+    cache_tag = sys.implementation.cache_tag
+    to_compile = []
+    for dst, definition in sorted(operations.items()):
+        if not dst.endswith(".py") or not definition.startswith("h "):
+            continue
+        dirname, basename = posixpath.split(dst)
+        pyc_dst = posixpath.join(dirname, "__pycache__", f"{basename[:-3]}.{cache_tag}.pyc")
+        if pyc_dst in operations:
+            continue  # Already precompiled by the build
+        pyc = (output_dir / pyc_dst).as_posix()
+        to_compile.append((definition[2:].strip('"'), pyc, dst))
+        _add_pseudofile_def(operations, pyc_dst, f'h "{pyc}"')
+
+    # Compiling holds the GIL, so it's done in worker processes instead of threads
+    if jobs <= 1:
+        for item in to_compile:
+            _compile_pyc(item)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(_compile_pyc, to_compile, chunksize=64):
+                pass
+
+
+_ELF_MAGIC = b"\x7fELF"
+_ELF_TYPE_EXEC = 2
+_ELF_TYPE_DYN = 3
+_ELF_SECTION_TYPE_NOTE = 7
+_ELF_NOTE_GNU_BUILD_ID = 3
+
+
+def _elf_header(path: str) -> tuple[str, int, bytes] | None:
+    """Return the struct byte order, word size and header of an executable or shared object, or None for other files."""
+    with Path(path).open("rb") as f:
+        header = f.read(64)
+    if len(header) < 52 or not header.startswith(_ELF_MAGIC):
+        return None
+    byte_order = "<" if header[5] == 1 else ">"
+    word_size = 8 if header[4] == 2 else 4
+    (elf_type,) = struct.unpack_from(f"{byte_order}H", header, 16)
+    if elf_type not in (_ELF_TYPE_EXEC, _ELF_TYPE_DYN):
+        return None
+    return byte_order, word_size, header
+
+
+def elf_build_id(path: str) -> str | None:
+    """Return the GNU build ID of an ELF file as hex string, or None if it doesn't have one."""
+    elf = _elf_header(path)
+    if elf is None:
+        return None
+    byte_order, word_size, header = elf
+    word = "Q" if word_size == 8 else "I"
+    shoff_offset, shentsize_offset = (0x28, 0x3A) if word_size == 8 else (0x20, 0x2E)
+    (shoff,) = struct.unpack_from(f"{byte_order}{word}", header, shoff_offset)
+    shentsize, shnum = struct.unpack_from(f"{byte_order}HH", header, shentsize_offset)
+    with Path(path).open("rb") as f:
+        for i in range(shnum):
+            f.seek(shoff + i * shentsize)
+            # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size
+            section = f.read(8 + 4 * word_size)
+            _, sh_type, _, _, offset, size = struct.unpack(f"{byte_order}II{word}{word}{word}{word}", section)
+            if sh_type != _ELF_SECTION_TYPE_NOTE:
+                continue
+            f.seek(offset)
+            notes = f.read(size)
+            pos = 0
+            while pos + 12 <= len(notes):
+                namesz, descsz, note_type = struct.unpack_from(f"{byte_order}III", notes, pos)
+                name_start = pos + 12
+                desc_start = name_start + (namesz + 3) // 4 * 4
+                if note_type == _ELF_NOTE_GNU_BUILD_ID and notes[name_start : name_start + namesz] == b"GNU\0":
+                    return notes[desc_start : desc_start + descsz].hex()
+                pos = desc_start + (descsz + 3) // 4 * 4
+    return None
+
+
+def strip_elf_files(operations: dict[str, str], strip: str, output_dir: Path, jobs: int = 1) -> list[str]:
+    """Replace executables and shared objects in the AppDir with copies without debug info.
+
+    Returns the original files that were replaced.
+    """
+    files = sorted((dst, d[2:].strip('"')) for dst, d in operations.items() if d.startswith("h "))
+    is_elf = dict(zip(files, _parallel_map(lambda file: _elf_header(file[1]) is not None, files, jobs)))
+    elf_files = [file for file in files if is_elf[file]]
+
+    def strip_file(file: tuple[str, str]) -> str:
+        dst, src = file
+        stripped = output_dir / dst
+        stripped.parent.mkdir(parents=True, exist_ok=True)
+        subprocess.run([strip, "--strip-debug", "-o", stripped, src], check=True)
+        return stripped.as_posix()
+
+    for (dst, _), stripped in zip(elf_files, _parallel_map(strip_file, elf_files, jobs)):
+        operations[dst] = f'h "{stripped}"'
+    return sorted({src for _, src in elf_files})
+
+
+def write_debuginfo(srcs: Sequence[str], objcopy: str, debuginfo_dir: Path, jobs: int = 1) -> None:
+    """Copy the debug info of ELF files into debuginfo_dir.
+
+    The files are laid out as `.build-id/xx/yyyy.debug`, which is where debuggers and debuginfod look them up by build
+    ID. Files without a build ID are skipped.
+    """
+
+    def write(src: str) -> None:
+        if build_id := elf_build_id(src):
+            debuginfo = debuginfo_dir / ".build-id" / build_id[:2] / f"{build_id[2:]}.debug"
+            debuginfo.parent.mkdir(parents=True, exist_ok=True)
+            subprocess.run([objcopy, "--only-keep-debug", src, debuginfo], check=True)
+
+    collections.deque(_parallel_map(write, srcs, jobs), maxlen=0)
+
+
+def hard_link_duplicates(operations: dict[str, str], jobs: int = 1) -> None:
+    """Turn files with the same contents and permissions as another file into hard links to it.
+
+    This way each file is only read once. All files in the image are pseudo files, so the links are "L" definitions.
+    The first file in path order keeps its definition. Only files with the same size as another file are read to compare
+    their contents, and sources that are the same file on disk are not read at all. Owners don't need to match because
+    the image is built with -all-root. Files that only differ in permissions can't share an inode, so mksquashfs' own
+    duplicate check still stores their contents once.
+    """
+    files = sorted((dst, d[2:].strip('"')) for dst, d in operations.items() if d.startswith("h "))
+    srcs = sorted({src for _, src in files})
+    src_stats = dict(zip(srcs, _parallel_map(lambda src: Path(src).stat(), srcs, jobs)))
+    same_file: dict[tuple[int, int], str] = {}
+    canonical = {src: same_file.setdefault((st.st_dev, st.st_ino), src) for src, st in src_stats.items()}
+    srcs_by_size = collections.defaultdict(list)
+    for src in sorted(set(canonical.values())):
+        srcs_by_size[src_stats[src].st_size].append(src)
+    candidates = [src for group in srcs_by_size.values() if len(group) > 1 for src in group]
+    digests = dict(zip(candidates, _parallel_map(_file_digest, candidates, jobs)))
+
+    # Hard links share one inode, so files that differ in permissions must not be merged
+    first_dst: dict[tuple[int, int, bytes | str], str] = {}
+    for dst, src in files:
+        canonical_src = canonical[src]
+        st = src_stats[canonical_src]
+        key = (stat.S_IMODE(st.st_mode), st.st_size, digests.get(canonical_src, canonical_src))
+        if key in first_dst:
+            operations[dst] = f'L "{first_dst[key]}"'
+        else:
+            first_dst[key] = dst
+
+
+def resolve_hard_links(pseudofile_defs: dict[str, str]) -> dict[str, str]:
+    """Replace hard links with the definition of the file they link to."""
+    return {dst: pseudofile_defs[d[2:].strip('"')] if d.startswith("L ") else d for dst, d in pseudofile_defs.items()}
+
+
+# mksquashfs sort priorities are signed 16-bit. Files with a higher priority are placed first, the default is 0.
+_SORT_PRIORITY_MAX = 32767
+# Whitespace and backslashes in sort file paths must be escaped with a backslash.
+_SORT_FILE_SPECIAL_CHARS = re.compile(r"([\\\s])")
+
+
+def make_sort_file_lines(pseudofile_defs: dict[str, str], startup_trace: Iterable[str]) -> list[str]:
+    """Return mksquashfs sort file lines that place the files in startup_trace first, in the order they are listed.
+
+    startup_trace lists paths inside the AppDir. The lines name the source files relative to the execroot, like the pf
+    file does, so that the sort file doesn't depend on where the action runs. mksquashfs matches sort file entries to
+    files by inode without following symlinks, so mkappimage.sh resolves them before passing them on.
+    """
+    lines: list[str] = []
+    seen = set()
+    for path in startup_trace:
+        if not path.strip() or path.startswith("#"):
+            continue
+        definition = pseudofile_defs.get(posixpath.normpath(path), "")
+        if not definition.startswith("h "):
+            continue  # Not a regular file (anymore)
+        # mksquashfs takes paths that start with "./" relative to its working directory
+        src = posixpath.join(".", posixpath.normpath(definition[2:].strip('"')))
+        if src in seen:
+            continue
+        seen.add(src)
+        priority = max(_SORT_PRIORITY_MAX - len(lines), 1)
+        escaped_src = _SORT_FILE_SPECIAL_CHARS.sub(r"\\\1", src)
+        lines.append(f"{escaped_src} {priority}")
+    return lines
+
+
+def _size_groups(dst: str) -> tuple[str, str]:
+    """Return the repository and the top-level directory in the repository that an AppDir path is attributed to."""
+    parts = dst.split("/")
+    if len(parts) < 3 or not parts[0].endswith(".runfiles"):
+        return ".", "."  # Outside of the runfiles, e.g. AppRun
+    repo = parts[1]
+    return repo, posixpath.join(repo, parts[2]) if len(parts) > 3 else repo
+
+
+def make_size_breakdown(pseudofile_defs: dict[str, str], jobs: int = 1) -> dict[str, dict[str, dict[str, int]]]:
+    """Sum up the size of all files in the AppDir by repository and by top-level directory in the repository.
+
+    Like mksquashfs, files with the same contents are only stored once. The size of every copy but the first (in path
+    order) is counted as duplicate_bytes.
+    """
+    files = sorted((dst, d[2:].strip('"')) for dst, d in pseudofile_defs.items() if d.startswith("h "))
+    srcs = sorted({src for _, src in files})
+    sizes = dict(zip(srcs, _parallel_map(lambda src: Path(src).stat().st_size, srcs, jobs)))
+    srcs_by_size = collections.defaultdict(set)
+    for src, size in sizes.items():
+        srcs_by_size[size].add(src)
+
+    breakdown: dict[str, dict[str, dict[str, int]]] = {"repositories": {}, "directories": {}}
+    seen_contents = set()
+    for dst, src in files:
+        size = sizes[src]
+        # Only read the file if there is another file with the same size
+        contents = (size, _file_digest(src) if len(srcs_by_size[size]) > 1 else src)
+        duplicate = contents in seen_contents
+        seen_contents.add(contents)
+        for kind, group in zip(breakdown, _size_groups(dst)):
+            totals = breakdown[kind].setdefault(group, {"files": 0, "bytes": 0, "duplicate_bytes": 0})
+            totals["files"] += 1
+            totals["bytes"] += size
+            totals["duplicate_bytes"] += size if duplicate else 0
+    return breakdown
+
+
+def make_stats(pseudofile_defs: dict[str, str], manifest: Path, jobs: int = 1) -> dict[str, Any]:
+    """Count the entries of the AppDir by type and sum up the size of all files that are copied into it."""
+    kinds = collections.Counter(definition[0] for definition in pseudofile_defs.values())
+    srcs = {definition[2:].strip('"') for definition in pseudofile_defs.values() if definition.startswith("h ")}
+    return {
+        "files": kinds["h"] + kinds["f"],
+        "symlinks": kinds["s"],
+        "directories": kinds["d"],
+        "tree_artifacts": sum(1 for _ in _Manifest(manifest).tree_artifacts()),
+        "input_bytes": sum(_parallel_map(lambda src: Path(src).stat().st_size, sorted(srcs), jobs)),
+        "sizes": make_size_breakdown(pseudofile_defs, jobs),
+    }
+
+
+def write_appdir_pseudofile_defs(pseudofile_defs: dict[str, str], apprun: Path, output: Path) -> None:
+    """Write a mksquashfs pf file representing the AppDir.
+
+    See https://github.com/plougher/squashfs-tools/blob/d8cb82d/USAGE#L753
+    and https://github.com/plougher/squashfs-tools/blob/d8cb82d/examples/pseudo-file.example
+
+    Pseudo file definition formats used here:
+    "filename d mode uid gid"               create a directory
+    "filename f mode uid gid command"       create file from stdout of command
+    "filename h filename"                   create file from copy (hard-link) of filename
+    "filename s mode uid gid symlink"       create a symbolic link (mode is ignored)
+    "filename L pseudo_filename"            create a hard-link to another pseudo file (see hard_link_duplicates)
+    """
     lines = [
         f"AppRun h {apprun}",
         *sorted(f'"{k}" {v}' for k, v in pseudofile_defs.items()),
@@ -380,14 +902,98 @@ def write_appdir_pseudofile_defs(manifest: Path, apprun: Path, runfiles_manifest
     output.write_text("\n".join(lines))
 
 
+def _max_rss_bytes() -> int:
+    """Peak RSS of this process or any of its children, e.g. strip."""
+    max_rss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def main(args: argparse.Namespace) -> None:
+    """Write the pf file and the optional outputs: exclusion report, .pyc and stripped files, stats and sort file."""
+    start = time.perf_counter()
+    start_times = os.times()
+    pseudofile_defs = make_appdir_pseudofile_defs(args.manifest, args.runfiles_manifest, args.jobs)
+    if args.exclude:
+        excluded = exclude_pseudofile_defs(pseudofile_defs, args.exclude, args.include)
+        # The files that the rule already left out of the manifest are reported together with the rest
+        excluded.update((file.dst, f'h "{file.src}"') for file in _Manifest(args.manifest).excluded_files())
+        excluded = dict(sorted(excluded.items()))
+        if args.excluded_report:
+            report = make_exclusion_report(excluded, pseudofile_defs)
+            args.excluded_report.write_text(json.dumps(report, indent=2) + "\n")
+    if args.precompile_dir:
+        precompile_python(pseudofile_defs, args.precompile_dir, args.python_version, args.jobs)
+    if args.strip:
+        stripped = strip_elf_files(pseudofile_defs, args.strip, args.strip_dir, args.jobs)
+        if args.objcopy and args.debuginfo_dir:
+            write_debuginfo(stripped, args.objcopy, args.debuginfo_dir, args.jobs)
+    hard_link_duplicates(pseudofile_defs, args.jobs)
+    write_appdir_pseudofile_defs(pseudofile_defs, args.apprun, args.output)
+
+    pseudofile_defs = resolve_hard_links(pseudofile_defs)
+    pseudofile_defs["AppRun"] = f'h "{args.apprun}"'
+    if args.sort_file:
+        trace = args.startup_trace.read_text().splitlines() if args.startup_trace else []
+        args.sort_file.write_text("".join(f"{line}\n" for line in make_sort_file_lines(pseudofile_defs, trace)))
+    if args.stats:
+        args.stats.write_text(json.dumps(make_stats(pseudofile_defs, args.manifest, args.jobs)))
+    if args.phase:
+        # Same format as the phases measured by profile_phases. In a persistent worker, the peak RSS is that of the
+        # worker process so far, not only of this request.
+        end_times = os.times()
+        phase = {
+            "name": "mkappdir",
+            "wall_s": round(time.perf_counter() - start, 3),
+            "user_s": round(end_times.user + end_times.children_user - start_times.user - start_times.children_user, 3),
+            "system_s": round(
+                end_times.system + end_times.children_system - start_times.system - start_times.children_system, 3
+            ),
+            "max_rss_bytes": _max_rss_bytes(),
+        }
+        args.phase.write_text(json.dumps(phase, indent=2) + "\n")
+
+
+def run_persistent_worker(requests: IO[str], responses: IO[str]) -> None:
+    """Serve JSON work requests from Bazel until requests is closed.
+
+    See https://bazel.build/remote/creating for the protocol. Results of probing the inputs are kept between requests,
+    so that rebuilding an AppImage after a small change doesn't have to read all of its files again.
+    """
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        _input_cache.start_request(request.get("inputs", []))
+        output = io.StringIO()
+        exit_code = 0
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                main(parse_args(request.get("arguments", [])))
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                output.write(f"{e.code}\n")
+                exit_code = 1
+        except Exception:
+            output.write(traceback.format_exc())
+            exit_code = 1
+        response = {"exitCode": exit_code, "output": output.getvalue()}
+        if "requestId" in request:
+            response["requestId"] = request["requestId"]
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+
 def parse_args(args: Sequence[str]) -> argparse.Namespace:
     """Parse command line arguments."""
-    parser = argparse.ArgumentParser(description="Prepare and build AppImages.")
+    parser = argparse.ArgumentParser(description="Prepare and build AppImages.", fromfile_prefix_chars="@")
     parser.add_argument(
         "--manifest",
         required=True,
         type=Path,
-        help="Path to manifest json with file and link definitions, e.g. 'bazel-bin/tests/appimage_py-manifest.json'",
+        help="Path to manifest with file and link definitions, e.g. 'bazel-bin/tests/appimage_py.manifest.txt'",
     )
     parser.add_argument(
         "--apprun",
@@ -401,10 +1007,64 @@ def parse_args(args: Sequence[str]) -> argparse.Namespace:
         type=Path,
         help="Path to write generated MANIFEST file to",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of threads used to inspect the input files. The output does not depend on this.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="Glob of paths inside the AppDir to leave out. Can be repeated.",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        help="Glob of paths to keep even though they match --exclude. Can be repeated.",
+    )
+    parser.add_argument("--excluded_report", type=Path, help="Where to write JSON listing what --exclude left out")
+    parser.add_argument(
+        "--startup_trace",
+        type=Path,
+        help="Paths inside the AppDir in the order they are accessed at startup, e.g. from record_startup_trace",
+    )
+    parser.add_argument(
+        "--sort_file",
+        type=Path,
+        help="Where to write a mksquashfs sort file that places the files in --startup_trace first",
+    )
+    parser.add_argument(
+        "--precompile_dir",
+        type=Path,
+        help="Compile all .py files and write the .pyc files here. They are added to the AppDir's __pycache__ dirs.",
+    )
+    parser.add_argument(
+        "--python_version",
+        help="major.minor version of the packaged Python interpreter. --precompile_dir fails if it doesn't match.",
+    )
+    parser.add_argument("--strip", help="strip tool. If set, executables and shared objects are stripped.")
+    parser.add_argument("--strip_dir", type=Path, help="Where to write the stripped files")
+    parser.add_argument("--objcopy", help="objcopy tool, used to keep the debug info of stripped files")
+    parser.add_argument("--debuginfo_dir", type=Path, help="Where to write the debug info of stripped files")
+    parser.add_argument("--stats", type=Path, help="Where to write JSON with the number of entries and input bytes")
+    parser.add_argument(
+        "--phase",
+        type=Path,
+        help="Where to write JSON with the wall time, CPU time and peak RSS of mkappdir. Unlike --stats, this is not "
+        "reproducible.",
+    )
     parser.add_argument("output", type=Path, help="Where to place output AppDir pseudo-file definition file")
     return parser.parse_args(args)
 
 
 if __name__ == "__main__":
-    args = parse_args(sys.argv[1:])
-    write_appdir_pseudofile_defs(args.manifest, args.apprun, args.runfiles_manifest, args.output)
+    if "--persistent_worker" in sys.argv[1:]:
+        # Keep the protocol stream to ourselves, so that tools like strip can't write into it
+        responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        run_persistent_worker(sys.stdin, responses)
+    else:
+        main(parse_args(sys.argv[1:]))
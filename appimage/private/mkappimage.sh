@@ -21,37 +21,79 @@ set -e
 
 set -eu
 
-mkappdir="$(rlocation rules_appimage/appimage/private/mkappdir)"
 mksquashfs="$(rlocation squashfs-tools/mksquashfs)"
+profile_phases="$(rlocation rules_appimage/appimage/private/profile_phases)"
 
-manifest="$1"
-shift
-apprun="$1"
-shift
-runfiles_manifest="$1"
-shift
 pseudofile_defs="$1"
 shift
-sqfs="$1"
+stats="$1"
 shift
 runtime="$1"
 shift
 appimage="$1"
 shift
+extract_cache="$1"
+shift
+profile="$1"
+shift
+size_report="$1"
+shift
+size_budget="$1"
+shift
+sort_file="$1"
+shift
+
+# Any further args are passed to mksquashfs.
+# The pseudo file definitions that explain to mksquashfs how to create the AppDir were written by mkappdir in a
+# separate action.
 
-# Create the mksquashfs pseudo file definitions file.
-# This explains to mksquashfs how to create the AppDir.
-"$mkappdir" --manifest "$manifest" --apprun "$apprun" \
-    --runfiles_manifest "$runfiles_manifest" \
-    "$pseudofile_defs"
+# Scratch space for intermediate files
+tmpdir="$(mktemp -d)"
+trap 'rm -rf "$tmpdir"' EXIT
+phases="$tmpdir/phases.jsonl"
+
+# The sort file names files relative to the execroot. mksquashfs matches its entries to files by inode without following
+# symlinks, so they are resolved here, where the inputs are staged.
+sort_args=()
+if [[ -n "$sort_file" ]]; then
+    paths=()
+    priorities=()
+    # shellcheck disable=SC2162 # Without -r, read removes the backslashes that escape special chars
+    while IFS= read line; do
+        paths+=("${line% *}")
+        priorities+=("${line##* }")
+    done <"$sort_file"
+    if [[ ${#paths[@]} -gt 0 ]]; then
+        realpath -- "${paths[@]}" | sed 's/[[:space:]\\]/\\&/g' |
+            paste -d ' ' - <(printf '%s\n' "${priorities[@]}") >"$tmpdir/sort.txt"
+        sort_args=(-sort "$tmpdir/sort.txt")
+    fi
+fi
 
 # Point mksquashfs at an empty dir so it doesn't include any other files
-emptydir="$(mktemp -d)"
-trap 'rm -rf "$emptydir"' EXIT
+emptydir="$tmpdir/empty"
+mkdir "$emptydir"
+
+# Create the final AppImage, which is the AppImage runtime followed by the squashfs image of the AppDir.
+# The squashfs image is written straight into the AppImage behind a gap the size of the runtime, and the runtime is
+# then written into that gap. This way the (potentially multi-GB) image is only written once.
+offset="$(($(wc -c <"$runtime")))"
+"$profile_phases" run "$phases" mksquashfs -- \
+    "$mksquashfs" "$emptydir" "$appimage" -offset "$offset" -pf "$pseudofile_defs" ${sort_args[@]+"${sort_args[@]}"} "$@"
+"$profile_phases" run "$phases" runtime -- \
+    dd if="$runtime" of="$appimage" conv=notrunc 2>/dev/null
 
-# Create the squashfs image
-"$mksquashfs" "$emptydir" "$sqfs" -pf "$pseudofile_defs" "$@"
+# Append the digest of the squashfs image, which is used as cache key by extract_and_run_cached.sh.
+# The AppImage runtime and squashfs readers ignore data after the end of the squashfs image.
+if [[ "$extract_cache" == 1 ]]; then
+    sha256=(sha256sum)
+    command -v sha256sum >/dev/null || sha256=(shasum -a 256)
+    # shellcheck disable=SC2016 # Expanded by the inner shell
+    "$profile_phases" run "$phases" digest -- \
+        bash -c 'tail -c +"$(($1 + 1))" "$2" | "${@:4}" >"$3"' _ "$offset" "$appimage" "$tmpdir/digest" "${sha256[@]}"
+    digest="$(cat "$tmpdir/digest")"
+    printf 'rules_appimage-sha256:%s\n' "${digest%% *}" >>"$appimage"
+fi
 
-# Create the final AppImage
-# by concatenating the AppImage runtime and the squashfs image of the AppDir
-cat "$runtime" "$sqfs" >"$appimage"
+"$profile_phases" report "$phases" --stats "$stats" --runtime "$runtime" --appimage "$appimage" --output "$profile" \
+    --size_report "$size_report" --size_budget "$size_budget"
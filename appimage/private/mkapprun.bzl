@@ -2,14 +2,17 @@
 
 load("//appimage/private:runfiles.bzl", "get_entrypoint", "get_workdir")
 
-def _make_env_sh(ctx):
-    env_file = ctx.actions.declare_file(ctx.attr.name + "-env.sh")
-
+def _get_env(ctx):
     # Take the `binary` env and add the appimage target's env on top of it
     env = {}
     if RunEnvironmentInfo in ctx.attr.binary:
         env.update(ctx.attr.binary[RunEnvironmentInfo].environment)
     env.update(ctx.attr.env)
+    return env
+
+def _make_env_sh(ctx):
+    env_file = ctx.actions.declare_file(ctx.attr.name + "-env.sh")
+    env = _get_env(ctx)
 
     # Export the current environment to a file so that it can be re-sourced in AppRun
     cmd = " | ".join([
@@ -89,15 +92,39 @@ def _make_apprun_setup(ctx):
     )
     return apprun_file_trailer
 
+def _make_native_apprun(ctx):
+    # The native launcher reads its config from the end of its own executable, see apprun.c for the format.
+    config_lines = [get_workdir(ctx), get_entrypoint(ctx)]
+    for key, value in _get_env(ctx).items():
+        if "\n" in key or "=" in key or "\n" in value:
+            fail("The native launcher does not support env {} with '=' or newlines in the name or newlines in the value".format(repr(key)))
+        config_lines.append("{}={}".format(key, value))
+    config_file = ctx.actions.declare_file(ctx.attr.name + "-apprun.conf")
+    ctx.actions.write(output = config_file, content = "\n".join(config_lines) + "\n")
+
+    launcher = ctx.executable.launcher
+    apprun_file = ctx.actions.declare_file(ctx.attr.name + ".AppRun")
+    ctx.actions.run_shell(
+        inputs = [launcher, config_file],
+        outputs = [apprun_file],
+        arguments = [launcher.path, config_file.path, apprun_file.path],
+        command = 'cat "$1" "$2" > "$3" && printf "%010dAPPRUN" "$(($(wc -c <"$2")))" >> "$3"',
+    )
+    return apprun_file
+
 def make_apprun(ctx):
     """Generate the AppRun.
 
+    This is a shell script by default, or the native `launcher` with its launch config appended if one is set.
+
     Args:
         ctx: The context object.
 
     Returns:
         The generated AppRun file.
     """
+    if ctx.attr.launcher:
+        return _make_native_apprun(ctx)
     env_file = _make_env_sh(ctx)
     apprun_file_trailer = _make_apprun_setup(ctx)
     apprun_file = ctx.actions.declare_file(ctx.attr.name + ".AppRun")
@@ -0,0 +1,106 @@
+"""Measure the phases of the AppImage action and write a JSON profile.
+
+`profile_phases.py run PHASES NAME -- CMD...` runs CMD and appends its wall time, CPU time and peak RSS to PHASES.
+`profile_phases.py report PHASES ...` combines the phases with the AppDir stats from mkappdir and the output size, and
+writes a size report that attributes the size to repositories and directories.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+
+def run(phases: Path, name: str, cmd: Sequence[str]) -> int:
+    """Run cmd and append a JSON line with its resource usage to phases. Returns the exit code of cmd."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_s = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    max_rss_bytes = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    phase = {
+        "name": name,
+        "wall_s": round(wall_s, 3),
+        "user_s": round(rusage.ru_utime, 3),
+        "system_s": round(rusage.ru_stime, 3),
+        "max_rss_bytes": max_rss_bytes,
+    }
+    with phases.open("a") as f:
+        f.write(json.dumps(phase) + "\n")
+    return proc.returncode
+
+
+def report(phases: Path, stats: Path, runtime: Path, appimage: Path) -> tuple[dict[str, Any], dict[str, Any]]:
+    """Combine the measured phases, the AppDir stats and the output size into a profile and a size report."""
+    appdir = json.loads(stats.read_text())
+    sizes = appdir.pop("sizes")
+    squashfs_bytes = appimage.stat().st_size - runtime.stat().st_size
+    profile = {
+        "phases": [json.loads(line) for line in phases.read_text().splitlines()],
+        "appdir": appdir,
+        "output_bytes": appimage.stat().st_size,
+        "squashfs_bytes": squashfs_bytes,
+        "compression_ratio": round(appdir["input_bytes"] / squashfs_bytes, 3) if squashfs_bytes else None,
+    }
+
+    # The sizes are uncompressed: neither mksquashfs nor unsquashfs report compressed sizes per file
+    size_report = {"output_bytes": appimage.stat().st_size, **sizes}
+    return profile, size_report
+
+
+def check_size_budget(size_report: dict[str, Any], size_budget_bytes: int, max_groups: int = 10) -> str | None:
+    """Return an error message listing the biggest directories if the AppImage is larger than the budget."""
+    if not size_budget_bytes or size_report["output_bytes"] <= size_budget_bytes:
+        return None
+    lines = [
+        f"AppImage is {size_report['output_bytes']} bytes, which exceeds the size budget of {size_budget_bytes} bytes.",
+        "Biggest directories (uncompressed bytes, not counting duplicates):",
+    ]
+    directories = [
+        (group["bytes"] - group["duplicate_bytes"], name) for name, group in size_report["directories"].items()
+    ]
+    lines.extend(
+        f"  {stored_bytes:>14} {name}" for stored_bytes, name in sorted(directories, reverse=True)[:max_groups]
+    )
+    return "\n".join(lines)
+
+
+def parse_args(args: Sequence[str]) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run and measure a phase")
+    run_parser.add_argument("phases", type=Path, help="JSON lines file to append the measurements to")
+    run_parser.add_argument("name", help="Name of the phase")
+    run_parser.add_argument("cmd", nargs="+", help="Command to run")
+    report_parser = subparsers.add_parser("report", help="Write the profile")
+    report_parser.add_argument("phases", type=Path, help="JSON lines file with the measured phases")
+    report_parser.add_argument("--stats", required=True, type=Path, help="AppDir stats written by mkappdir")
+    report_parser.add_argument("--runtime", required=True, type=Path, help="AppImage runtime")
+    report_parser.add_argument("--appimage", required=True, type=Path, help="The built AppImage")
+    report_parser.add_argument("--output", required=True, type=Path, help="Where to write the JSON profile")
+    report_parser.add_argument("--size_report", required=True, type=Path, help="Where to write the JSON size report")
+    report_parser.add_argument("--size_budget", type=int, default=0, help="Fail if the AppImage is larger (bytes)")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.command == "run":
+        sys.exit(run(args.phases, args.name, args.cmd))
+    profile, size_report = report(args.phases, args.stats, args.runtime, args.appimage)
+    args.output.write_text(json.dumps(profile, indent=2) + "\n")
+    args.size_report.write_text(json.dumps(size_report, indent=2) + "\n")
+    if error := check_size_budget(size_report, args.size_budget):
+        sys.exit(error)
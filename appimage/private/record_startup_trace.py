@@ -0,0 +1,79 @@
+"""Record which files an AppImage reads at startup, in the order they are first read.
+
+The AppImage is extracted, the access times of all files are reset, and the extracted AppRun is run once. Files whose
+access time changed were read, and sorting them by access time gives the order. The output can be passed to the
+`startup_trace` attribute of the `appimage` rule.
+
+This relies on the kernel updating access times, which it doesn't do on file systems mounted with `noatime`. Access
+times only advance once per timer tick, so files first read within the same tick are listed in path order.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+
+def reset_access_times(root: Path) -> None:
+    """Set the access times of all regular files below root to the epoch.
+
+    With the default `relatime` mount option, the kernel then updates the access time on the next read.
+    """
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath, filename)
+            st = path.lstat()
+            if stat.S_ISREG(st.st_mode):
+                os.utime(path, ns=(0, st.st_mtime_ns))
+
+
+def accessed_files(root: Path) -> list[str]:
+    """Return the paths of all regular files below root that were read since reset_access_times, oldest first."""
+    accessed = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath, filename)
+            st = path.lstat()
+            if stat.S_ISREG(st.st_mode) and st.st_atime_ns > 0:
+                accessed.append((st.st_atime_ns, path.relative_to(root).as_posix()))
+    return [path for _, path in sorted(accessed)]
+
+
+def record_startup_trace(appimage: Path, args: Sequence[str]) -> list[str]:
+    """Run the AppImage once and return the files it read, in the order they were first read."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subprocess.run([appimage.resolve(), "--appimage-extract"], cwd=tmpdir, check=True, stdout=subprocess.DEVNULL)
+        root = Path(tmpdir) / "squashfs-root"
+        reset_access_times(root)
+        subprocess.run([root / "AppRun", *args], check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        return accessed_files(root)
+
+
+def parse_args(args: Sequence[str]) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", type=Path, help="Write the trace here instead of stdout")
+    parser.add_argument("appimage", type=Path, help="AppImage to trace")
+    parser.add_argument("args", nargs="*", help="Arguments passed to the AppImage")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    trace = record_startup_trace(args.appimage, args.args)
+    if not trace:
+        sys.exit("No file access recorded. Is the temporary directory on a file system mounted with noatime?")
+    text = "".join(f"{path}\n" for path in trace)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        sys.stdout.write(text)
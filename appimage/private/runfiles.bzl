@@ -40,48 +40,35 @@ def _reference_dir(ctx):
     """
     return "/".join([_runfiles_dir(ctx), ctx.workspace_name])
 
-def _final_emptyfile_path(ctx, name):
-    """The final location that this empty file needs to exist at for the foo_binary target to properly execute.
+def _emptyfile_path(name):
+    """The location of an empty file relative to _reference_dir.
 
     Examples:
     With --legacy_external_runfiles (default in Bazel <8):
-      tests/__init__.py -> tests/test_py.runfiles/_main/tests/__init__.py
-      external/__init__.py -> tests/test_py.runfiles/__init__.py
-      external/rules_python~/__init__.py -> tools/wheelmaker.runfiles/rules_python~/__init__.py
+      tests/__init__.py -> tests/__init__.py (tests/test_py.runfiles/_main/tests/__init__.py)
+      external/__init__.py -> ../__init__.py (tests/test_py.runfiles/__init__.py)
+      external/rules_python~/__init__.py -> ../rules_python~/__init__.py (tools/wheelmaker.runfiles/rules_python~/__init__.py)
     With --nolegaxy_external_runfiles (default in Bazel 8+):
-      tests/__init__.py -> tests/test_py.runfiles/_main/tests/__init__.py
-      ../__init__.py -> tests/test_py.runfiles/__init__.py
-      ../rules_python~/__init__.py -> tools/wheelmaker.runfiles/rules_python~/__init__.py
+      tests/__init__.py -> tests/__init__.py (tests/test_py.runfiles/_main/tests/__init__.py)
+      ../__init__.py -> ../__init__.py (tests/test_py.runfiles/__init__.py)
+      ../rules_python~/__init__.py -> ../rules_python~/__init__.py (tools/wheelmaker.runfiles/rules_python~/__init__.py)
     """
     if name.startswith("external/"):
-        relative_name = name[len("external/"):]
-    elif name.startswith("../"):
-        relative_name = name[len("../"):]
-    else:
-        # Names that don't start with external or ../ are relative to our own workspace.
-        return _reference_dir(ctx) + "/" + name
-
-    # References to workspace-external dependencies, which are identifiable
-    # because their path begins with external/ or ../, are inconsistent with the
-    # form of their File counterparts, whose ".short_form" is relative to
-    #    .../foo.runfiles/workspace-name/  (aka _reference_dir(ctx))
-    # whereas we see:
-    #    external/foreign-workspace/...
-    # so we "fix" the empty files' paths by removing "external/" and basing them
-    # directly on the runfiles path.
-    return _runfiles_dir(ctx) + "/" + relative_name
-
-def _final_file_path(ctx, f):
-    """The final location that this file needs to exist at for the foo_binary target to properly execute."""
-    return "/".join([_reference_dir(ctx), f.short_path])
-
-def _final_symlink_path(ctx, sl):
-    """The final location that this symlink needs to exist at for the foo_binary target to properly execute."""
-    return "/".join([_reference_dir(ctx), sl.path])
-
-def _final_root_symlink_path(ctx, sl):
-    """The final location that this root symlink needs to exist at for the foo_binary target to properly execute."""
-    return "/".join([_runfiles_dir(ctx), sl.path])
+        # References to workspace-external dependencies, which are identifiable
+        # because their path begins with external/ or ../, are inconsistent with the
+        # form of their File counterparts, whose ".short_form" is relative to
+        #    .../foo.runfiles/workspace-name/  (aka _reference_dir(ctx))
+        # whereas we see:
+        #    external/foreign-workspace/...
+        # so we "fix" the empty files' paths by basing them directly on the runfiles path.
+        return "../" + name[len("external/"):]
+
+    # Names that start with ../ are already relative to the runfiles dir, others are relative to our own workspace.
+    return name
+
+def _appdir_path(ctx, path):
+    """A path relative to the AppDir root, expressed relative to _reference_dir like all paths in the manifest."""
+    return "/".join([".."] * len(_reference_dir(ctx).split("/")) + [path])
 
 def _default_runfiles(dep):
     return dep[DefaultInfo].default_runfiles.files
@@ -95,6 +82,110 @@ def _default_symlinks(dep):
 def _default_root_symlinks(dep):
     return dep[DefaultInfo].default_runfiles.root_symlinks
 
+def _manifest_record(kind, *fields):
+    """A line of the manifest. See _Manifest in mkappdir.py for the format."""
+    return "\t".join([kind] + list(fields))
+
+def _manifest_copy(f, dst):
+    """A manifest record to copy a file to dst.
+
+    mkappdir looks at every file on disk, because even generated files that are not declared symlinks can be symlinks,
+    e.g. the outputs of `ln -s` in a genrule. Those are kept as relative symlinks in the AppDir.
+    """
+    return _manifest_record("f", f.path, dst)
+
+# The functions below are called by Bazel to expand the depsets in the manifest during execution. They can't depend
+# on ctx, so all paths they return are relative to _reference_dir.
+
+def _runfile_record(f):
+    if f.is_directory:
+        return _manifest_record("t", f.path, f.short_path)
+    return _manifest_copy(f, f.short_path)
+
+def _emptyfile_record(name):
+    return _manifest_record("e", _emptyfile_path(name))
+
+def _symlink_record(sl):
+    return _manifest_record("l", sl.path, sl.target_file.short_path)
+
+def _root_symlink_record(sl):
+    return _manifest_record("l", "../" + sl.path, sl.target_file.short_path)
+
+def _root_symlink_target_record(sl):
+    # Root symlink target files may not be in default_runfiles.files, must ensure they're in the manifest.
+    return _runfile_record(sl.target_file)
+
+def _normpath(path):
+    """Like Python's posixpath.normpath for relative paths."""
+    parts = []
+    for part in path.split("/"):
+        if part == ".." and parts and parts[-1] != "..":
+            parts.pop()
+        elif part not in ("", "."):
+            parts.append(part)
+    return "/".join(parts) or "."
+
+def _glob_match(pattern, name):
+    """Whether name matches pattern, where `*` matches any string, including `/`, and `?` any character.
+
+    Starlark has neither regexes nor while loops, so this is the usual backtracking wildcard match with a bounded loop.
+    """
+    p = 0
+    n = 0
+    star = -1
+    star_n = 0
+    for _ in range((len(pattern) + 1) * (len(name) + 2)):
+        if n == len(name):
+            break
+        if p < len(pattern) and pattern[p] in ("?", name[n]):
+            p += 1
+            n += 1
+        elif p < len(pattern) and pattern[p] == "*":
+            star = p
+            star_n = n
+            p += 1
+        elif star >= 0:
+            p = star + 1
+            star_n += 1
+            n = star_n
+        else:
+            return False
+    return n == len(name) and not pattern[p:].replace("*", "")
+
+def _glob_matches(patterns, path):
+    """Patterns without `/` match the file name, patterns with `/` match the whole path. See _glob_matcher in mkappdir."""
+    name = path.rsplit("/", 1)[-1]
+    for pattern in patterns:
+        if _glob_match(pattern, path if "/" in pattern else name):
+            return True
+    return False
+
+def _is_excluded(path, excludes, includes):
+    """Whether the innermost match of path or one of its parent directories is one of the excludes."""
+    parts = path.split("/")
+    for i in range(len(parts), 0, -1):
+        parent = "/".join(parts[:i])
+        if _glob_matches(includes, parent):
+            return False
+        if _glob_matches(excludes, parent):
+            return True
+    return False
+
+def _excluding_runfile_record(reference_dir, excludes, includes):
+    """Return a map_each callback like _runfile_record that turns the runfiles that match excludes into "x" records.
+
+    Tree artifacts are always left to mkappdir. So are files that may be directories if there are includes, because
+    includes could keep something inside them.
+    """
+
+    def runfile_record(f):
+        may_be_directory = f.is_directory or (includes and (f.is_source or f.is_symlink))
+        if not may_be_directory and _is_excluded(_normpath(reference_dir + "/" + f.short_path), excludes, includes):
+            return _manifest_record("x", f.path, f.short_path)
+        return _runfile_record(f)
+
+    return runfile_record
+
 def get_workdir(ctx):
     return "/".join([_runfiles_dir(ctx), ctx.attr.binary.label.workspace_name or ctx.workspace_name])
 
@@ -104,6 +195,8 @@ def get_entrypoint(ctx):
 def collect_runfiles_info(ctx):
     """Collect application files and runfiles.
 
+    The runfiles depsets are not flattened during analysis. Bazel expands them into the manifest during execution.
+
     Args:
         ctx: Bazel runtime context
 
@@ -112,58 +205,60 @@ def collect_runfiles_info(ctx):
         _directory: Target base directory ("AppDir")
 
     Returns:
-        struct with infos about files needed by app.
+        struct with a depset of the files needed by the app and the Args that expand to the lines of the manifest that
+        describes the AppDir.
     """
-
-    # Collect everything that needs to be in the appimage and deduplicate using depset.
-    runfiles_list = depset(ctx.files.data, transitive = [_default_runfiles(ctx.attr.binary)] + [_default_runfiles(d) for d in ctx.attr.data]).to_list()
-    file_map = {f.path: _final_file_path(ctx, f) for f in runfiles_list if not f.is_directory}
+    deps = [ctx.attr.binary] + ctx.attr.data
+    runfiles = depset(ctx.files.data, transitive = [_default_runfiles(d) for d in deps])
+    emptyfiles = depset(transitive = [_default_emptyfiles(d) for d in deps])
+    symlinks = depset(transitive = [_default_symlinks(d) for d in deps])
+    root_symlinks = depset(transitive = [_default_root_symlinks(d) for d in deps])
     repo_mapping = ctx.attr.binary[DefaultInfo].files_to_run.repo_mapping_manifest
+    runfiles_manifest = ctx.attr.binary[DefaultInfo].files_to_run.runfiles_manifest
 
-    # Add the repo_mapping but not the runfiles_manifest. We generate our own MANIFEST file.
-    file_map.update({repo_mapping.path: repo_mapping.short_path})
-
-    tree_artifacts_map = {f.path: _final_file_path(ctx, f) for f in runfiles_list if f.is_directory}
+    manifest = ctx.actions.args()
+    manifest.set_param_file_format("multiline")
+    manifest.add(_manifest_record("r", repo_mapping.basename, runfiles_manifest.short_path, _reference_dir(ctx)))
 
     # Handle empty_filenames. This is used for some __init__.py files.
-    emptyfiles_list = depset(transitive = [_default_emptyfiles(ctx.attr.binary)] + [_default_emptyfiles(d) for d in ctx.attr.data]).to_list()
-    empty_files = [_final_emptyfile_path(ctx, f) for f in emptyfiles_list]
-
-    # Handle symlinks. See https://bazel.build/extending/rules#runfiles_symlinks
-    symlinks_list = depset(transitive = [_default_symlinks(ctx.attr.binary)] + [_default_symlinks(d) for d in ctx.attr.data]).to_list()
-    symlinks = {_final_symlink_path(ctx, sl): _final_file_path(ctx, sl.target_file) for sl in symlinks_list}
-
-    root_symlinks_list = depset(transitive = [_default_root_symlinks(ctx.attr.binary)] + [_default_root_symlinks(d) for d in ctx.attr.data]).to_list()
-    symlinks.update({_final_root_symlink_path(ctx, sl): _final_file_path(ctx, sl.target_file) for sl in root_symlinks_list})
+    manifest.add_all(emptyfiles, map_each = _emptyfile_record)
+
+    # Tree artifacts are copied by mkappdir, so they must not be expanded here.
+    # Excluded runfiles stay inputs, because the depset can't be filtered without flattening it, but they are marked as
+    # such here so that mkappdir never looks at them. Character classes are only supported by mkappdir's fnmatch.
+    excludes = ctx.attr.excludes
+    includes = ctx.attr.includes
+    if excludes and not [pattern for pattern in excludes + includes if "[" in pattern]:
+        manifest.add_all(
+            runfiles,
+            map_each = _excluding_runfile_record(_reference_dir(ctx), excludes, includes),
+            expand_directories = False,
+            allow_closure = True,
+        )
+    else:
+        manifest.add_all(runfiles, map_each = _runfile_record, expand_directories = False)
+    manifest.add_all(root_symlinks, map_each = _root_symlink_target_record)
 
-    # Root symlink target files may not be in default_runfiles.files, must ensure they're in the file map.
-    root_symlink_files = [sl.target_file for sl in root_symlinks_list]
-    for rslf in root_symlink_files:
-        file_map.setdefault(rslf.path, _final_file_path(ctx, rslf))
+    # Add the repo_mapping but not the runfiles_manifest. We generate our own MANIFEST file.
+    manifest.add(_manifest_copy(repo_mapping, _appdir_path(ctx, repo_mapping.short_path)))
 
-    symlinks.update({
+    # Handle symlinks. See https://bazel.build/extending/rules#runfiles_symlinks
+    manifest.add_all(symlinks, map_each = _symlink_record)
+    manifest.add_all(root_symlinks, map_each = _root_symlink_record)
+    manifest.add_all([
         # Create a symlink from the entrypoint to where it will actually be put under runfiles.
-        get_entrypoint(ctx): _final_file_path(ctx, ctx.executable.binary),
+        _manifest_record("l", _appdir_path(ctx, get_entrypoint(ctx)), ctx.executable.binary.short_path),
         # Create the --legacy_external_runfiles symlink from <workspace>/external to the runfiles root
         # For @foo//bar/baz:blah this would translate to /app/bar/baz/blah.runfiles/foo/external
         # This is needed until --nolegacy_external_runfiles is not supported anymore
-        _reference_dir(ctx) + "/external": _runfiles_dir(ctx),
+        _manifest_record("l", "external", ".."),
         # Symlink the _repo_mapping so that runfiles libraries can find it
-        _runfiles_dir(ctx) + "/_repo_mapping": repo_mapping.short_path,
-    })
+        _manifest_record("l", "../_repo_mapping", _appdir_path(ctx, repo_mapping.short_path)),
+    ])
 
-    runfiles_manifest = ctx.attr.binary[DefaultInfo].files_to_run.runfiles_manifest
-    manifest = struct(
-        empty_files = empty_files,
-        files = [struct(src = src, dst = dst) for src, dst in file_map.items()],
-        files_to_run = {
-            "repo_mapping_basename": repo_mapping.basename,
-            "runfiles_manifest_short_path": runfiles_manifest.short_path,
-        },
-        symlinks = [struct(linkname = linkname, target = target) for linkname, target in symlinks.items()],
-        tree_artifacts = [struct(src = src, dst = dst) for src, dst in tree_artifacts_map.items()],
-    )
+    # Root symlinks are rare, so flattening them is cheap. Their target files are inputs, but may not be runfiles.
+    root_symlink_files = [sl.target_file for sl in root_symlinks.to_list()]
     return struct(
-        files = runfiles_list + root_symlink_files + [repo_mapping, runfiles_manifest],
+        files = depset([repo_mapping, runfiles_manifest] + root_symlink_files, transitive = [runfiles]),
         manifest = manifest,
     )
@@ -3,12 +3,19 @@
 def _appimage_toolchain_impl(ctx):
     return [platform_common.ToolchainInfo(
         appimage_runtime = ctx.file.appimage_runtime,
+        resources = ctx.attr.resources,
     )]
 
 appimage_toolchain = rule(
     implementation = _appimage_toolchain_impl,
     attrs = {
         "appimage_runtime": attr.label(allow_single_file = True),
+        "resources": attr.string(
+            default = "medium",
+            values = ["auto", "small", "medium", "large", "xlarge"],
+            doc = "Default resource class of the AppImage action for `appimage()` targets that don't set `resources`. " +
+                  "`auto` flattens the runfiles of every target during analysis, so it is not the default.",
+        ),
     },
     doc = """Declare an AppImage toolchain wrapping a platform-specific AppImage runtime binary.
 
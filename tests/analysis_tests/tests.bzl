@@ -2,6 +2,7 @@
 
 load("@rules_shell//shell:sh_binary.bzl", "sh_binary")
 load("@rules_testing//lib:analysis_test.bzl", "analysis_test", "test_suite")
+load("@rules_testing//lib:truth.bzl", "matching")
 load("@rules_testing//lib:util.bzl", "util")
 load("//appimage:appimage.bzl", "appimage")
 
@@ -29,8 +30,136 @@ def _basic_impl(env, target):
         "tests/analysis_tests/basic.appimage",
     ])
 
+    # The default resource class doesn't depend on the number of files, so the runfiles aren't flattened
+    env.expect.that_target(target).action_named("AppImage").argv().contains_at_least([
+        "-processors",
+        "4",
+        "-mem",
+        "1024M",
+    ]).in_order()
+
+    # Duplicates that differ in permissions can't be hard links, so mksquashfs must still look for duplicates
+    env.expect.that_target(target).action_named("AppImage").argv().not_contains("-no-duplicates")
+
+def _resources(name):
+    util.helper_target(
+        sh_binary,
+        name = "%s_binary" % name,
+        srcs = ["program.sh"],
+    )
+
+    util.helper_target(
+        appimage,
+        name = "%s.appimage" % name,
+        binary = ":%s_binary" % name,
+        resources = "large",
+    )
+
+    analysis_test(
+        name = name,
+        impl = _resources_impl,
+        target = ":%s.appimage" % name,
+    )
+
+def _resources_impl(env, target):
+    env.expect.that_target(target).action_named("AppImage").argv().contains_at_least([
+        "-processors",
+        "8",
+        "-mem",
+        "2048M",
+    ]).in_order()
+
+def _compression(name):
+    util.helper_target(
+        sh_binary,
+        name = "%s_binary" % name,
+        srcs = ["program.sh"],
+    )
+
+    util.helper_target(
+        appimage,
+        name = "%s.appimage" % name,
+        binary = ":%s_binary" % name,
+        compression = "fast",
+        uncompressed = ["*.whl", "site-packages/*.gz"],
+    )
+
+    analysis_test(
+        name = name,
+        impl = _compression_impl,
+        target = ":%s.appimage" % name,
+    )
+
+def _compression_impl(env, target):
+    env.expect.that_target(target).action_named("AppImage").argv().contains_at_least([
+        "-comp",
+        "lz4",
+        "-action",
+        "uncompressed@name(*.whl)",
+        "-action",
+        "uncompressed@pathname(site-packages/*.gz)",
+    ]).in_order()
+
+def _excludes(name):
+    util.helper_target(
+        sh_binary,
+        name = "%s_binary" % name,
+        srcs = ["program.sh"],
+    )
+
+    util.helper_target(
+        appimage,
+        name = "%s.appimage" % name,
+        binary = ":%s_binary" % name,
+        excludes = ["tests", "*.pyi"],
+        includes = ["conftest.py"],
+    )
+
+    analysis_test(
+        name = name,
+        impl = _excludes_impl,
+        target = ":%s.appimage" % name,
+    )
+
+def _excludes_impl(env, target):
+    env.expect.that_target(target).action_named("AppDir").argv().contains_at_least([
+        "--exclude",
+        "tests",
+        "--exclude",
+        "*.pyi",
+        "--include",
+        "conftest.py",
+    ]).in_order()
+    env.expect.that_target(target).output_group("appimage_debug").contains_predicate(
+        matching.file_basename_equals("%s.excluded.json" % target.label.name),
+    )
+
+def _path_mapping(name):
+    util.helper_target(
+        sh_binary,
+        name = "%s_binary" % name,
+        srcs = ["program.sh"],
+    )
+
+    util.helper_target(
+        appimage,
+        name = "%s.appimage" % name,
+        binary = ":%s_binary" % name,
+    )
+
+    analysis_test(
+        name = name,
+        impl = _path_mapping_impl,
+        target = ":%s.appimage" % name,
+    )
+
+def _path_mapping_impl(env, target):
+    actions = {action.mnemonic: action for action in target.actions}
+    for mnemonic in ["AppDirManifest", "AppDir", "AppImage"]:
+        env.expect.that_dict(actions[mnemonic].execution_info).contains_at_least({"supports-path-mapping": "1"})
+
 def appimage_test_suite(name):
     test_suite(
         name = name,
-        tests = [_basic],
+        tests = [_basic, _resources, _compression, _excludes, _path_mapping],
     )
@@ -0,0 +1,144 @@
+"""Measure the startup latency of an AppImage when mounted with FUSE and when extracted.
+
+Run e.g. `bazel run //tests:benchmark_appimage -- --runs 50 $PWD/bazel-bin/tests/appimage_py -- --name x`.
+The benchmarked program should exit right away, so that the wall time is dominated by startup.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+# AppImage runtime CLI args that select how the payload is accessed. FUSE is the default.
+MODES = {
+    "fuse": [],
+    "extract-and-run": ["--appimage-extract-and-run"],
+}
+
+# ru_inblock is counted in 512-byte units regardless of the filesystem block size.
+_INBLOCK_UNIT = 512
+
+
+class Sample(NamedTuple):
+    """Measurements of a single AppImage run."""
+
+    wall_s: float
+    major_faults: int
+    minor_faults: int
+    read_bytes: int
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def evict_from_page_cache(path: Path) -> None:
+    """Drop the file's pages from the page cache, so that the next run has to read the SquashFS from disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def run_once(cmd: Sequence[str], env: dict[str, str], cwd: Path) -> Sample:
+    """Run cmd to completion and measure it and all the processes it waited for."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_s = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return Sample(
+        wall_s=wall_s,
+        major_faults=rusage.ru_majflt,
+        minor_faults=rusage.ru_minflt,
+        read_bytes=rusage.ru_inblock * _INBLOCK_UNIT,
+    )
+
+
+def summarize(samples: Sequence[Sample]) -> dict[str, dict[str, float]]:
+    """Compute p50/p95 of each measurement."""
+    return {
+        field: {
+            "p50": percentile([getattr(s, field) for s in samples], 50),
+            "p95": percentile([getattr(s, field) for s in samples], 95),
+        }
+        for field in Sample._fields
+    }
+
+
+def benchmark_cmd(cmd: Sequence[str], runs: int, warmup: int, cold: bool) -> dict[str, dict[str, float]]:
+    """Run cmd, whose first element is the AppImage, `runs` times and summarize the measurements."""
+    env = {k: v for k, v in os.environ.items() if k != "APPIMAGE_EXTRACT_AND_RUN"}
+    cwd = Path(env.get("TEST_TMPDIR", Path.cwd()))
+    for _ in range(warmup):
+        run_once(cmd, env, cwd)
+    samples = []
+    for _ in range(runs):
+        if cold:
+            evict_from_page_cache(Path(cmd[0]))
+        samples.append(run_once(cmd, env, cwd))
+    return summarize(samples)
+
+
+def benchmark(args: argparse.Namespace) -> dict[str, object]:
+    """Run the AppImage `args.runs` times in each mode and return the results as JSON-serializable dict."""
+    appimage = args.appimage.resolve()
+    modes = {
+        mode: benchmark_cmd([str(appimage), *MODES[mode], *args.args], args.runs, args.warmup, args.cold)
+        for mode in args.mode or MODES
+    }
+    return {
+        "appimage": str(appimage),
+        "size_bytes": appimage.stat().st_size,
+        "runs": args.runs,
+        "cold": args.cold,
+        "modes": modes,
+    }
+
+
+def parse_args(args: Sequence[str]) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20, help="Number of measured runs per mode")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of unmeasured runs per mode")
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="Evict the AppImage from the page cache before each run. Without this, read_bytes is usually 0.",
+    )
+    parser.add_argument("--mode", choices=MODES, action="append", help="Only benchmark this mode. Can be repeated.")
+    parser.add_argument("--output", type=Path, help="Write the JSON results here instead of stdout")
+    parser.add_argument("appimage", type=Path, help="AppImage to benchmark")
+    parser.add_argument("args", nargs="*", help="Arguments passed to the AppImage")
+    return parser.parse_args(args)
+
+
+def main(argv: Sequence[str]) -> None:
+    """Benchmark an AppImage and print the results."""
+    args = parse_args(argv)
+    results = benchmark(args)
+    text = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        args.output.write_text(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,42 @@
+"""Tests for the AppImage startup benchmark."""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+from tests import benchmark_appimage
+
+APPIMAGE = Path.cwd() / "tests/appimage_py"
+
+
+@pytest.mark.parametrize(
+    ("values", "pct", "expected"),
+    [
+        ([1.0], 50, 1.0),
+        ([1.0], 95, 1.0),
+        ([3.0, 1.0, 2.0], 50, 2.0),
+        ([float(i) for i in range(1, 101)], 95, 95.0),
+        ([float(i) for i in range(1, 101)], 100, 100.0),
+    ],
+)
+def test_percentile(values: list[float], pct: float, expected: float) -> None:
+    assert benchmark_appimage.percentile(values, pct) == expected
+
+
+def test_benchmark(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("TMPDIR", str(tmp_path))  # extract-and-run extracts to $TMPDIR
+    output = tmp_path / "results.json"
+    argv = ["--runs=2", "--warmup=0", "--cold", "--mode=extract-and-run", f"--output={output}", str(APPIMAGE)]
+    benchmark_appimage.main([*argv, "--", "--name", "benchmark"])
+    results = json.loads(output.read_text())
+    assert results["runs"] == 2
+    assert set(results["modes"]) == {"extract-and-run"}
+    stats = results["modes"]["extract-and-run"]
+    assert set(stats) == {"wall_s", "major_faults", "minor_faults", "read_bytes"}
+    assert 0 < stats["wall_s"]["p50"] <= stats["wall_s"]["p95"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-v", __file__]))
@@ -0,0 +1,27 @@
+#!/bin/bash
+
+set -euxo pipefail
+
+extract_and_run_cached="$1"
+appimage="$2"
+export APPIMAGE_EXTRACT_CACHE="$TEST_TMPDIR/cache"
+
+# The digest trailer must not break running the AppImage itself
+[[ "$("$appimage" --appimage-extract-and-run)" == "hello world" ]]
+
+# Concurrent first runs share a single extraction
+for i in 1 2 3 4; do
+    "$extract_and_run_cached" "$appimage" >"$TEST_TMPDIR/out.$i" &
+done
+wait
+for out in "$TEST_TMPDIR"/out.*; do
+    [[ "$(cat "$out")" == "hello world" ]]
+done
+appdirs=("$APPIMAGE_EXTRACT_CACHE"/*/)
+[[ "${#appdirs[@]}" == 1 ]]
+
+# Later runs use the cache
+rm -f "${appdirs[0]}/AppRun"
+printf '#!/bin/sh\necho cached\n' >"${appdirs[0]}/AppRun"
+chmod +x "${appdirs[0]}/AppRun"
+[[ "$("$extract_and_run_cached" "$appimage")" == "cached" ]]
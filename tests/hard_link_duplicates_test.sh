@@ -0,0 +1,22 @@
+#!/bin/bash
+
+set -euxo pipefail
+
+unsquashfs="$1"
+appimage="$2"
+
+# Extract with unsquashfs, which recreates the hard links of the image
+offset="$("$appimage" --appimage-offset)"
+"$unsquashfs" -no-progress -o "$offset" -d "$TEST_TMPDIR/root" "$appimage" >/dev/null
+dir="$(dirname "$(find "$TEST_TMPDIR/root" -name copy1.txt)")"
+
+# Files with the same contents and permissions are stored once and share an inode
+[[ "$(stat -c %i "$dir/copy1.txt")" == "$(stat -c %i "$dir/copy2.txt")" ]]
+[[ "$(stat -c %h "$dir/copy1.txt")" == 2 ]]
+[[ ! -x "$dir/copy1.txt" ]]
+
+# A file with the same contents but different permissions keeps its own inode and mode. mksquashfs' duplicate check
+# stores its contents only once, but unsquashfs doesn't show that.
+[[ "$(stat -c %h "$dir/copy_executable.sh")" == 1 ]]
+[[ -x "$dir/copy_executable.sh" ]]
+[[ "$(cat "$dir/copy_executable.sh")" == "same contents" ]]
@@ -1,9 +1,16 @@
 """Unit tests for mkappdir module."""
 
 import contextlib
+import importlib.util
+import io
+import json
+import marshal
 import os
+import shutil
+import subprocess
 import sys
 import tempfile
+import time
 from collections.abc import Iterator
 from pathlib import Path
 
@@ -20,6 +27,7 @@ from appimage.private import mkappdir
         ("/usr/bin", "/", "usr/bin"),
         ("/a/b/c", "/a/b/d", "../c"),
         ("a/b/c/d", "a/b/d/e", "../../c/d"),
+        ("python3", "a.runfiles/_main/../repo/bin", "../../../python3"),
     ],
 )
 def test_relative_path(target: str, origin: str, expected: str) -> None:
@@ -48,23 +56,11 @@ def test_is_inside_bazel_cache(path: Path, expected: bool) -> None:
     assert inside == expected
 
 
-@pytest.mark.parametrize(
-    ("path", "expected"),
-    [
-        ("/", ["/"]),
-        (".", []),
-        ("/a", ["/"]),
-        ("./a", []),
-        ("/dev/null", ["/", "/dev"]),
-        ("/dev", ["/", "/dev"]),
-        ("a", []),
-        ("a/b", ["a"]),
-        ("a/b/c", ["a", "a/b"]),
-        ("a/b/c/d", ["a", "a/b", "a/b/c"]),
-    ],
-)
-def test_get_all_parent_dirs(path: str, expected: list[str]) -> None:
-    assert mkappdir.get_all_parent_dirs(Path(path)) == list(map(Path, expected))
+@pytest.fixture(autouse=True)
+def reset_input_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Don't let results of probing files in one test leak into another test that reuses the same file names."""
+    monkeypatch.setattr(mkappdir._input_cache, "_digests", None)
+    monkeypatch.setattr(mkappdir._input_cache, "_results", {})
 
 
 @contextlib.contextmanager
@@ -77,8 +73,8 @@ def cd(path: Path | str) -> Iterator[None]:
         os.chdir(old)
 
 
-def test_to_pseudofile_def_lines() -> None:
-    mkdef = mkappdir.to_pseudofile_def_lines
+def test_pseudofile_def() -> None:
+    mkdef = mkappdir._pseudofile_def
     with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
         src = Path("dir/space file")
         src.parent.mkdir(parents=True, exist_ok=True)
@@ -87,18 +83,397 @@ def test_to_pseudofile_def_lines() -> None:
         dangling.symlink_to("../invalid")
         link = Path("space link")
         link.symlink_to(src)
+        abs_link = Path("abs link")
+        abs_link.symlink_to(src.absolute())
 
-        assert mkdef(src, Path("a/b/c/d"), True) == {
+        assert mkdef(src, True) == 'h "dir/space file"'
+        assert mkdef(dangling, True) == "s 0 0 0 ../invalid"
+        assert mkdef(dangling, False) == "s 0 0 0 ../invalid"
+        assert mkdef(link, True) == "s 0 0 0 dir/space file"
+        assert mkdef(link, False) == 'h "space link"'
+        # Absolute symlinks into the execroot are resolved, wherever the execroot is
+        assert mkdef(abs_link, True) == 'h "abs link"'
+        assert mkdef(src.parent, True) == "d 755 0 0"
+
+        # Parent dirs are created as well
+        assert make_defs(("f", "dir/space file", "a/b/c/d")) == {
             "a": "d 755 0 0",
             "a/b": "d 755 0 0",
             "a/b/c": "d 755 0 0",
             "a/b/c/d": 'h "dir/space file"',
+            "MANIFEST": 'h "runfiles_manifest"',
         }
-        assert mkdef(src, Path("dst"), True) == {"dst": 'h "dir/space file"'}
-        assert mkdef(dangling, Path("dst"), True) == {"dst": "s 0 0 0 ../invalid"}
-        assert mkdef(dangling, Path("dst"), False) == {"dst": "s 0 0 0 ../invalid"}
-        assert mkdef(link, Path("dst"), True) == {"dst": "s 0 0 0 dir/space file"}
-        assert mkdef(link, Path("dst"), False) == {"dst": 'h "space link"'}
+
+
+def make_defs(*records: tuple[str, ...], jobs: int = 1) -> dict[str, str]:
+    """Write a manifest with the given records to the current dir and make pseudo-file definitions from it."""
+    lines = ["\t".join(record) for record in [("r", "repo_mapping", "MANIFEST"), *records]]
+    Path("manifest.txt").write_text("\n".join(lines) + "\n")
+    return mkappdir.make_appdir_pseudofile_defs(Path("manifest.txt"), Path("runfiles_manifest"), jobs)
+
+
+def test_copy_file_or_dir() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("tree/sub/empty").mkdir(parents=True)
+        Path("tree/sub/file").write_text("file")
+        Path("tree/sub/link").symlink_to("file")
+        operations: dict[str, str] = {}
+        mkappdir.copy_file_or_dir(operations, Path("tree"), Path("app/tree"), preserve_symlinks=True)
+        assert operations == {
+            "app": "d 755 0 0",
+            "app/tree": "d 755 0 0",
+            "app/tree/sub": "d 755 0 0",
+            "app/tree/sub/file": 'h "tree/sub/file"',
+            "app/tree/sub/link": "s 0 0 0 file",
+        }
+        assert not Path("app").exists()
+
+        os.mkfifo("tree/fifo")
+        with pytest.raises(NotImplementedError, match="Cannot handle tree/fifo"):
+            mkappdir.copy_file_or_dir({}, Path("tree"), Path("app/tree"), preserve_symlinks=True)
+
+
+def test_make_appdir_pseudofile_defs_reference_dir() -> None:
+    """Paths in the manifest are relative to the reference dir given in the r record."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("src").write_text("src")
+        records = [
+            ("r", "app.repo_mapping", "app.runfiles/MANIFEST", "app.runfiles/_main"),
+            ("e", "../__init__.py"),
+            ("f", "src", "pkg/file"),
+            ("f", "src", "../repo/file"),
+            ("f", "src", "../../app.repo_mapping"),
+            ("l", "../../app", "pkg/file"),
+            ("l", "external", ".."),
+        ]
+        Path("manifest.txt").write_text("".join("\t".join(record) + "\n" for record in records))
+        defs = mkappdir.make_appdir_pseudofile_defs(Path("manifest.txt"), Path("runfiles_manifest"))
+    assert defs["app.runfiles/__init__.py"] == "f 755 0 0 true"
+    assert defs["app.runfiles/_main/pkg/file"] == 'h "src"'
+    assert defs["app.runfiles/repo/file"] == 'h "src"'
+    assert defs["app.repo_mapping"] == 'h "src"'
+    assert defs["app"] == "s 0 0 0 app.runfiles/_main/pkg/file"
+    assert defs["app.runfiles/_main/external"] == "s 0 0 0 .."
+    assert defs["app.runfiles/MANIFEST"] == 'h "runfiles_manifest"'
+
+
+def test_make_appdir_pseudofile_defs_jobs() -> None:
+    """The output must not depend on the number of threads used to probe the inputs."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("tree/sub").mkdir(parents=True)
+        for i in range(100):
+            Path(f"src{i}").write_text(str(i))
+            Path(f"tree/sub/file{i}").write_text(str(i))
+            Path(f"link{i}").symlink_to(f"src{i}")
+        Path("tree/sub/link").symlink_to("file0")
+        records = [
+            *(("f", f"src{i}", f"app.runfiles/_main/src{i}") for i in range(100)),
+            *(("f", f"link{i}", f"app.runfiles/_main/link{i}") for i in range(100)),
+            ("t", "tree", "app.runfiles/_main/tree"),
+        ]
+
+        serial = make_defs(*records, jobs=1)
+        parallel = make_defs(*records, jobs=8)
+
+    assert serial == parallel
+    assert serial["app.runfiles/_main/link7"] == "s 0 0 0 src7"
+    assert serial["app.runfiles/_main/tree/sub/file7"] == 'h "tree/sub/file7"'
+
+
+def test_generated_relative_symlinks() -> None:
+    """Generated files can be symlinks even if they are not declared as such, e.g. after `ln -s` in a genrule."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("bazel-out/lib").mkdir(parents=True)
+        Path("bazel-out/lib/libfoo.so.1").write_text("ELF")
+        Path("bazel-out/lib/libfoo.so").symlink_to("libfoo.so.1")
+        defs = make_defs(
+            ("f", "bazel-out/lib/libfoo.so.1", "app.runfiles/_main/lib/libfoo.so.1"),
+            ("f", "bazel-out/lib/libfoo.so", "app.runfiles/_main/lib/libfoo.so"),
+        )
+        assert defs["app.runfiles/_main/lib/libfoo.so.1"] == 'h "bazel-out/lib/libfoo.so.1"'
+        assert defs["app.runfiles/_main/lib/libfoo.so"] == "s 0 0 0 libfoo.so.1"
+
+
+def test_duplicate_dsts() -> None:
+    """Duplicate dsts are fine as long as all srcs have the same contents."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("a").write_text("same")
+        Path("b").write_text("same")
+        Path("c").write_text("diff")
+        Path("d").write_text("different length")
+        Path("hardlink").hardlink_to("a")
+
+        assert make_defs(*(("f", src, "dst") for src in ("a", "b", "hardlink", "a")))["dst"] == 'h "a"'
+        for other in ("c", "d"):
+            with pytest.raises(NotImplementedError, match="different contents"):
+                make_defs(("f", "a", "dst"), ("f", other, "dst"))
+
+
+def test_exclude_pseudofile_defs() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("src").write_text("12345")
+        operations = make_defs(
+            ("f", "src", "app.runfiles/pkg/mod.py"),
+            ("f", "src", "app.runfiles/pkg/mod.pyi"),
+            ("f", "src", "app.runfiles/pkg/tests/test_mod.py"),
+            ("f", "src", "app.runfiles/pkg/tests/conftest.py"),
+            ("f", "src", "app.runfiles/pkg/tests/data/file"),
+            ("f", "src", "app.runfiles/pkg-1.0.dist-info/RECORD"),
+            ("l", "app.runfiles/pkg/link", "app.runfiles/pkg/tests/data/file"),
+        )
+        excluded = mkappdir.exclude_pseudofile_defs(
+            operations, ["tests", "*.pyi", "*.dist-info/RECORD"], ["conftest.py"]
+        )
+        assert list(excluded) == [
+            "app.runfiles/pkg-1.0.dist-info/RECORD",
+            "app.runfiles/pkg/mod.pyi",
+            "app.runfiles/pkg/tests/data",
+            "app.runfiles/pkg/tests/data/file",
+            "app.runfiles/pkg/tests/test_mod.py",
+        ]
+        # The parent dir of an included file is kept
+        assert operations["app.runfiles/pkg/tests"] == "d 755 0 0"
+        assert "app.runfiles/pkg/tests/conftest.py" in operations
+
+        report = mkappdir.make_exclusion_report(excluded, operations)
+        assert report["files"] == 4
+        assert report["bytes"] == 4 * 5
+        assert report["dangling_symlinks"] == ["app.runfiles/pkg/link"]
+
+
+def test_excluded_manifest_records() -> None:
+    """Files that the rule already excluded are never added to the AppDir, but are part of the exclusion report."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("src").write_text("12345")
+        make_defs(
+            ("f", "src", "app.runfiles/pkg/mod.py"),
+            ("x", "src", "app.runfiles/pkg/mod.pyi"),
+            ("f", "src", "app.runfiles/pkg/tests/test_mod.py"),
+            ("l", "app.runfiles/pkg/link", "app.runfiles/pkg/mod.pyi"),
+        )
+        Path("apprun").touch()
+        mkappdir.main(
+            mkappdir.parse_args(
+                [
+                    *("--manifest", "manifest.txt", "--apprun", "apprun", "--runfiles_manifest", "runfiles_manifest"),
+                    *("--exclude", "tests", "--exclude", "*.pyi", "--excluded_report", "report.json", "pf"),
+                ]
+            )
+        )
+        assert '"app.runfiles/pkg/mod.pyi"' not in Path("pf").read_text()
+        report = json.loads(Path("report.json").read_text())
+        assert report["excluded"] == [
+            "app.runfiles/pkg/mod.pyi",
+            "app.runfiles/pkg/tests",
+            "app.runfiles/pkg/tests/test_mod.py",
+        ]
+        assert report["files"] == 2
+        assert report["bytes"] == 2 * 5
+        assert report["dangling_symlinks"] == ["app.runfiles/pkg/link"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_precompile_python(jobs: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("mod.py").write_text("VALUE = 42\n")
+        Path("data.txt").write_text("not python")
+        operations = make_defs(("f", "mod.py", "app.runfiles/_main/pkg/mod.py"), ("f", "data.txt", "data.py"))
+        operations["data.py"] = "s 0 0 0 data.txt"
+        python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        with pytest.raises(ValueError, match=r"Can't precompile for Python 2\.7"):
+            mkappdir.precompile_python(operations, Path("pyc"), "2.7", jobs)
+        mkappdir.precompile_python(operations, Path("pyc"), python_version, jobs)
+
+        pyc = f"app.runfiles/_main/pkg/__pycache__/mod.{sys.implementation.cache_tag}.pyc"
+        assert operations[pyc] == f'h "pyc/{pyc}"'
+        assert operations["app.runfiles/_main/pkg/__pycache__"] == "d 755 0 0"
+        assert not any("__pycache__/data." in dst for dst in operations)
+
+        data = Path("pyc", pyc).read_bytes()
+        assert data[:4] == importlib.util.MAGIC_NUMBER
+        assert int.from_bytes(data[4:8], "little") == 0b01  # hash-based, unchecked
+        assert marshal.loads(data[16:]).co_filename == "app.runfiles/_main/pkg/mod.py"
+
+
+@pytest.mark.skipif(not all(map(shutil.which, ["cc", "strip", "objcopy"])), reason="needs cc, strip and objcopy")
+def test_strip_elf_files() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("main.c").write_text("int main(void) { return 0; }\n")
+        subprocess.run(["cc", "-g", "-Wl,--build-id", "-o", "main", "main.c"], check=True)
+        Path("data.txt").write_text("not an executable")
+        operations = make_defs(("f", "main", "app.runfiles/_main/main"), ("f", "data.txt", "data.txt"))
+        build_id = mkappdir.elf_build_id("main")
+        assert build_id
+        assert mkappdir.elf_build_id("data.txt") is None
+
+        stripped = mkappdir.strip_elf_files(operations, "strip", Path("stripped"), jobs=2)
+        assert stripped == ["main"]
+        assert operations["app.runfiles/_main/main"] == 'h "stripped/app.runfiles/_main/main"'
+        assert operations["data.txt"] == 'h "data.txt"'
+        assert Path("stripped/app.runfiles/_main/main").stat().st_size < Path("main").stat().st_size
+        assert mkappdir.elf_build_id("stripped/app.runfiles/_main/main") == build_id
+
+        mkappdir.write_debuginfo(stripped, "objcopy", Path("debug"), jobs=2)
+        assert Path("debug/.build-id", build_id[:2], f"{build_id[2:]}.debug").is_file()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_hard_link_duplicates(jobs: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("a").write_text("same")
+        Path("copy").write_text("same")
+        Path("executable").write_text("same")
+        Path("executable").chmod(0o755)
+        Path("a").chmod(0o644)
+        Path("copy").chmod(0o644)
+        Path("other").write_text("diff")
+        Path("unique").write_text("unique size")
+        Path("hardlink").hardlink_to("unique")
+        operations = {
+            "app/z": 'h "copy"',
+            "app/a": 'h "a"',
+            "app/a2": 'h "a"',
+            "app/exe": 'h "executable"',
+            "app/other": 'h "other"',
+            "app/unique": 'h "unique"',
+            "app/hardlink": 'h "hardlink"',
+            "app/empty": "f 755 0 0 true",
+        }
+        mkappdir.hard_link_duplicates(operations, jobs)
+        assert operations == {
+            "app/z": 'L "app/a"',
+            "app/a": 'h "a"',
+            "app/a2": 'L "app/a"',
+            "app/exe": 'h "executable"',  # Same contents, but different permissions
+            "app/other": 'h "other"',
+            "app/unique": 'L "app/hardlink"',
+            "app/hardlink": 'h "hardlink"',
+            "app/empty": "f 755 0 0 true",
+        }
+        assert mkappdir.resolve_hard_links(operations)["app/z"] == 'h "a"'
+
+
+def test_make_stats() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("tree/sub").mkdir(parents=True)
+        Path("tree/sub/file").write_text("12345")
+        Path("src").write_text("123")
+        records = [
+            ("e", "app.runfiles/_main/__init__.py"),
+            ("f", "src", "app.runfiles/_main/src"),
+            ("f", "src", "app.runfiles/_main/src_copy"),
+            ("l", "app", "app.runfiles/_main/src"),
+            ("t", "tree", "app.runfiles/_main/tree"),
+        ]
+        operations = make_defs(*records)
+        Path("runfiles_manifest").write_text("1234567")
+        stats = mkappdir.make_stats(operations, Path("manifest.txt"))
+
+    sizes = stats.pop("sizes")
+    assert stats == {
+        "files": 5,  # __init__.py, src, src_copy, file, MANIFEST
+        "symlinks": 1,
+        "directories": 4,  # app.runfiles, app.runfiles/_main, tree, tree/sub
+        "tree_artifacts": 1,
+        "input_bytes": 3 + 5 + 7,  # src only counts once
+    }
+    assert sizes["repositories"] == {
+        ".": {"files": 1, "bytes": 7, "duplicate_bytes": 0},  # MANIFEST
+        "_main": {"files": 3, "bytes": 3 + 3 + 5, "duplicate_bytes": 3},
+    }
+    assert sizes["directories"]["_main"] == {"files": 2, "bytes": 3 + 3, "duplicate_bytes": 3}  # src, src_copy
+    assert sizes["directories"]["_main/tree"] == {"files": 1, "bytes": 5, "duplicate_bytes": 0}
+
+
+def test_run_persistent_worker() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("a").write_text("same")
+        Path("b").write_text("same")
+        Path("c").write_text("different")
+        Path("link").symlink_to("a")
+        make_defs(("f", "link", "app"))
+        # Nothing is cached outside of a worker
+        assert not mkappdir._input_cache._results
+        Path("apprun").touch()
+        args = ["--manifest", "manifest.txt", "--apprun", "apprun", "--runfiles_manifest", "runfiles_manifest"]
+        Path("params").write_text("\n".join([*args, "--stats", "stats.json", "--phase", "phase.json", "pf"]) + "\n")
+
+        def request(request_id: int, digest: str, arguments: list[str]) -> str:
+            inputs = [{"path": "link", "digest": digest}, {"path": "manifest.txt", "digest": "m"}]
+            return json.dumps({"arguments": arguments, "inputs": inputs, "requestId": request_id}) + "\n"
+
+        def serve(*requests: str) -> list[dict[str, object]]:
+            responses = io.StringIO()
+            mkappdir.run_persistent_worker(io.StringIO("".join(requests)), responses)
+            return [json.loads(line) for line in responses.getvalue().splitlines()]
+
+        assert serve(request(1, "x", ["@params"])) == [{"exitCode": 0, "output": "", "requestId": 1}]
+        assert '"app" s 0 0 0 a' in Path("pf").read_text()
+        assert "phase" not in json.loads(Path("stats.json").read_text())
+        assert json.loads(Path("phase.json").read_text())["name"] == "mkappdir"
+
+        # Results of probing an input are reused while its digest and lstat don't change
+        assert mkappdir._input_cache._results
+        serve(request(2, "x", ["@params"]))
+        assert '"app" s 0 0 0 a' in Path("pf").read_text()
+
+        # Bazel's digest of a symlink is that of its target's contents, so it doesn't change here
+        Path("link").unlink()
+        Path("link").symlink_to("b")
+        serve(request(3, "x", ["@params"]))
+        assert '"app" s 0 0 0 b' in Path("pf").read_text()
+        Path("link").unlink()
+        Path("link").symlink_to("c")
+        serve(request(4, "y", ["@params"]))
+        assert '"app" s 0 0 0 c' in Path("pf").read_text()
+
+        [response] = serve(request(5, "y", ["--no_such_flag"]))
+        assert response["exitCode"] == 2
+        assert response["requestId"] == 5
+        assert "error: the following arguments are required" in str(response["output"])
+
+
+def test_make_sort_file_lines() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        for name in ["a", "b", "with space"]:
+            Path(name).write_text(name)
+        pseudofile_defs = {
+            "app/a": 'h "a"',
+            "app/a_copy": 'h "a"',
+            "app/b": 'h "b"',
+            "app/c": 'h "with space"',
+            "app/link": "s 0 0 0 a",
+            "app": "d 755 0 0",
+        }
+        trace = ["# comment", "app/c", "app/link", "app/./a", "", "app/a_copy", "app/missing", "app"]
+        lines = mkappdir.make_sort_file_lines(pseudofile_defs, trace)
+        assert lines == ["./with\\ space 32767", "./a 32766"]
+
+
+@pytest.mark.skipif("MKAPPDIR_BENCHMARK" not in os.environ, reason="set MKAPPDIR_BENCHMARK to run")
+@pytest.mark.parametrize("num_files", [100_000, 1_000_000])
+def test_make_appdir_pseudofile_defs_benchmark(num_files: int) -> None:
+    """Run make_appdir_pseudofile_defs on a synthetic manifest with many files in a deep directory tree."""
+    with tempfile.TemporaryDirectory() as tmp_dir, cd(tmp_dir):
+        Path("src").write_text("content")
+        runfiles = "app.runfiles/_main/site-packages"
+        records = [
+            *(("e", f"{runfiles}/pkg{i}/__init__.py") for i in range(100)),
+            *(("f", "src", f"{runfiles}/pkg{i % 100}/mod{i % 7}/sub{i % 13}/file{i}.py") for i in range(num_files)),
+            ("l", "app", f"{runfiles}/pkg0/mod0/sub0/file0.py"),
+        ]
+
+        start = time.perf_counter()
+        operations = make_defs(*records)
+        duration = time.perf_counter() - start
+
+    # Generous enough for slow CI machines, but far below what a quadratic algorithm needs for 100k files
+    assert duration < num_files * 100e-6, f"{num_files} files took {duration:.2f}s"
+
+    num_dirs = 3 + 100 + 100 * 7 + 100 * 7 * 13
+    assert len(operations) == num_files + 100 + num_dirs + len(["MANIFEST", "app"])
+    assert operations[f"{runfiles}/pkg1/mod1/sub1/file1.py"] == 'h "src"'
+    assert operations[f"{runfiles}/pkg1/mod1/sub1"] == "d 755 0 0"
 
 
 if __name__ == "__main__":
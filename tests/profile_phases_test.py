@@ -0,0 +1,53 @@
+"""Unit tests for profile_phases module."""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+from appimage.private import profile_phases
+
+
+def test_profile(tmp_path: Path) -> None:
+    phases = tmp_path / "phases.jsonl"
+    assert profile_phases.run(phases, "ok", [sys.executable, "-c", "pass"]) == 0
+    assert profile_phases.run(phases, "fail", [sys.executable, "-c", "raise SystemExit(3)"]) == 3
+
+    stats = tmp_path / "stats.json"
+    sizes = {
+        "repositories": {"repo": {"files": 3, "bytes": 1100, "duplicate_bytes": 100}},
+        "directories": {
+            "repo/big": {"files": 1, "bytes": 800, "duplicate_bytes": 0},
+            "repo/small": {"files": 2, "bytes": 300, "duplicate_bytes": 100},
+        },
+    }
+    stats.write_text(json.dumps({"files": 1, "input_bytes": 1000, "sizes": sizes}))
+    runtime = tmp_path / "runtime"
+    runtime.write_bytes(b"r" * 100)
+    appimage = tmp_path / "appimage"
+    appimage.write_bytes(b"r" * 100 + b"s" * 400)
+
+    profile, size_report = profile_phases.report(phases, stats, runtime, appimage)
+    assert [phase["name"] for phase in profile["phases"]] == ["ok", "fail"]
+    assert set(profile["phases"][0]) == {"name", "wall_s", "user_s", "system_s", "max_rss_bytes"}
+    assert profile["phases"][0]["max_rss_bytes"] > 0
+    assert profile["appdir"] == {"files": 1, "input_bytes": 1000}
+    assert profile["output_bytes"] == 500
+    assert profile["squashfs_bytes"] == 400
+    assert profile["compression_ratio"] == 2.5
+
+    assert size_report["output_bytes"] == 500
+    assert size_report["repositories"] == sizes["repositories"]
+    assert size_report["directories"] == sizes["directories"]
+
+    assert profile_phases.check_size_budget(size_report, 0) is None
+    assert profile_phases.check_size_budget(size_report, 500) is None
+    error = profile_phases.check_size_budget(size_report, 499)
+    assert error is not None
+    assert "exceeds the size budget of 499 bytes" in error
+    assert error.index("800 repo/big") < error.index("200 repo/small")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,27 @@
+"""Unit tests for record_startup_trace module."""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+from appimage.private import record_startup_trace
+
+
+def test_accessed_files(tmp_path: Path) -> None:
+    (tmp_path / "sub").mkdir()
+    for name in ["first", "second", "unread", "sub/third"]:
+        (tmp_path / name).write_text(name)
+    (tmp_path / "link").symlink_to("first")
+    record_startup_trace.reset_access_times(tmp_path)
+    assert record_startup_trace.accessed_files(tmp_path) == []
+
+    # Set access times explicitly instead of reading, so that the test doesn't depend on the mount options
+    for atime, name in enumerate(["second", "sub/third", "first"], start=1):
+        os.utime(tmp_path / name, ns=(atime, 0))
+    assert record_startup_trace.accessed_files(tmp_path) == ["second", "sub/third", "first"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))